@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+"""
+Memory footprint of a tree 'files' map: legacy dict of dicts versus EntryMap.
+
+Each layout is built in a forked process. 'peak' is the resident set size growth (Linux only), 
+'retained' is the deep size of the resulting structure, as reported by sys.getsizeof().
+
+    ./treeMemory.py --entries 1000000
+"""
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from lib.entryMap import EntryMap, FILE_FIELDS, strings
+
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def deepSize(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (k, v) in obj.iteritems():
+            size += deepSize(k, seen) + deepSize(v, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for x in obj:
+            size += deepSize(x, seen)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, array):
+        size += deepSize(obj.__dict__, seen)
+    return size
+
+def entries(count):
+    owners = ["hive", "spark", "sa"]
+    for i in xrange(count):
+        path = "warehouse/db{0:02d}/table{1:04d}/part-{2:06d}.parquet".format(i / 500000, (i / 100) % 5000, i)
+        f = {}
+        f['size'] = 1000 + i
+        f['modificationTime'] = 1480983919 + i
+        f['mode'] = "0644"
+        f['owner'] = owners[i % 3]
+        f['group'] = "hadoop"
+        yield (path, f)
+
+def measure(layout, count, result):
+    before = rss()
+    start = time.time()
+    if layout == "dict":
+        m = {}
+    else:
+        m = EntryMap(FILE_FIELDS)
+    prefix = None
+    for (path, f) in entries(count):
+        if layout != "dict":
+            # Freeze each directory once completed, as the tree walkers do.
+            p = path[:path.rfind('/') + 1]
+            if p != prefix:
+                if prefix != None:
+                    m.freeze(prefix)
+                prefix = p
+        m[path] = f
+    if layout != "dict":
+        m.freeze()
+    duration = time.time() - start
+    peak = rss() - before
+    seen = set()
+    if layout != "dict":
+        # Strings table is shared by all maps. Not accounted.
+        seen.add(id(strings))
+    retained = deepSize(m, seen)
+    # Lookup all entries, as the diff will do
+    start = time.time()
+    for (path, _) in entries(count):
+        m[path]
+    result.put((peak, retained, duration, time.time() - start))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', required=False, type=int, default=1000000)
+    params = parser.parse_args()
+    print("{0} entries".format(params.entries))
+    print("{0:10} {1:>10} {2:>14} {3:>14} {4:>10} {5:>10}".format("layout", "peak (MB)", "retained (MB)", "retained/entry", "build (s)", "lookup (s)"))
+    for layout in ["dict", "EntryMap"]:
+        result = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure, args=(layout, params.entries, result))
+        p.start()
+        (peak, retained, build, lookup) = result.get()
+        p.join()
+        print("{0:10} {1:10.1f} {2:14.1f} {3:14.0f} {4:10.1f} {5:10.1f}".format(layout, peak / 1048576.0, retained / 1048576.0, float(retained) / params.entries, build, lookup))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
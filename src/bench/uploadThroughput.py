@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+"""
+Upload throughput of a single file: Plain file object (requests/httplib read it by 8KB blocks) versus fastio.FileBody.
+
+The datanode is stood in by a local HTTP server, in a forked process, which discards the data. Test files are sparse,
+so the disk is not measured, only the client path.
+
+    ./uploadThroughput.py --sizes 1M,100M,10G --chunkSize 1048576
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+import BaseHTTPServer
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from lib.fastio import FileBody
+
+
+class DiscardHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    rbufsize = 0    # So the body is not left in a python buffer, behind recv_into()
+    wbufsize = -1   # Response in one segment. Line by line, Nagle would delay it by 40ms
+
+    def do_PUT(self):
+        remaining = int(self.headers['content-length'])
+        buf = bytearray(1024 * 1024)
+        while remaining > 0:
+            n = self.connection.recv_into(buf, min(len(buf), remaining))
+            if n == 0:
+                break
+            remaining -= n
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def serve(server):
+    server.serve_forever()
+
+def parseSize(s):
+    units = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+    if s[-1].upper() in units:
+        return int(s[:-1]) * units[s[-1].upper()]
+    return int(s)
+
+def upload(session, url, path, mode, chunkSize):
+    start = time.time()
+    if mode == "file":
+        with open(path, "rb") as f:
+            resp = session.put(url, data=f, headers={'content-type': 'application/octet-stream'})
+    else:
+        with FileBody(path, chunkSize) as body:
+            resp = session.put(url, data=body, headers={'content-type': 'application/octet-stream'})
+    if resp.status_code != 201:
+        raise Exception("HTTP {0}".format(resp.status_code))
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', required=False, default="1M,100M,10G")
+    parser.add_argument('--chunkSize', required=False, type=int, default=1048576)
+    parser.add_argument('--runs', required=False, type=int, default=3, help="Best of n runs")
+    parser.add_argument('--tmpDir', required=False, default=tempfile.gettempdir())
+    params = parser.parse_args()
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), DiscardHandler)
+    url = "http://127.0.0.1:{0}/webhdfs/v1/bench?op=CREATE".format(server.server_address[1])
+    process = multiprocessing.Process(target=serve, args=(server,))
+    process.daemon = True
+    process.start()
+    server.socket.close()
+    session = requests.Session()
+
+    print("{0:>8} {1:>14} {2:>16} {3:>8}".format("size", "file (MB/s)", "FileBody (MB/s)", "ratio"))
+    for size in params.sizes.split(","):
+        length = parseSize(size)
+        (fd, path) = tempfile.mkstemp(dir=params.tmpDir)
+        try:
+            os.ftruncate(fd, length)
+            os.close(fd)
+            rates = {}
+            for mode in ["file", "FileBody"]:
+                duration = min(upload(session, url, path, mode, params.chunkSize) for _ in range(params.runs))
+                rates[mode] = length / 1048576.0 / max(duration, 1e-6)
+            print("{0:>8} {1:14.0f} {2:16.0f} {3:8.2f}".format(size, rates['file'], rates['FileBody'], rates['FileBody'] / rates['file']))
+        finally:
+            os.remove(path)
+    process.terminate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
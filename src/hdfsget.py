@@ -24,10 +24,22 @@ import yaml
 import lib.WebHDFS as WebHDFS
 import lib.buildTree as buildTree
 import sys
-import Queue    
+import itertools
+from array import array
 from threading import Thread
+import threading
 import time
 import lib.common as common
+import lib.planner as planner
+import lib.listingCache as listingCache
+import lib.pruner as pruner
+import lib.scheduler as scheduler
+import lib.engine as engine
+import lib.processes as processes
+import lib.checksum as checksum
+import lib.checksumCache as checksumCache
+import lib.concurrency as concurrency
+import lib.fastio as fastio
 import atexit 
 
 
@@ -35,13 +47,13 @@ logger = logging.getLogger("hdfsget.main")
 tlogger = logging.getLogger("hdfsget.thread")
 
 
-def applyAttrOnNewFile(path, p):
+def applyAttrOnNewFile(localFile, p):
     if p.owner != None:
-        os.chown(path, misc.getUidFromName(p.owner), -1)
+        localFile.chown(misc.getUidFromName(p.owner), -1)
     if p.group != None:
-        os.chown(path, -1, misc.getGidFromName(p.group))
+        localFile.chown(-1, misc.getGidFromName(p.group))
     if p.mode != None:
-        os.chmod(path, int(p.mode, 8))
+        localFile.chmod(int(p.mode, 8))
 
 
 def applyAttrOnNewDirectory(path, p):
@@ -69,25 +81,6 @@ def adjustAttrOnExistingDir(dirPath, dirStatus, p):
     if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
         os.chmod(dirPath, int(p.directoryMode, 8))
 
-def checkAttrOnExistingFile(fileStatus, p):
-    if p.owner != None and p.owner != fileStatus['owner']:
-        return True
-    if p.group != None and p.group != fileStatus['group']:
-        return True
-    if(p.mode != None and fileStatus['mode'] != p.mode):
-        return True
-    return False
-
-def checkAttrOnExistingDir(dirStatus, p):
-    if p.owner != None and p.owner != dirStatus['owner']:
-        return True
-    if p.group != None and p.group != dirStatus['group']:
-        return True
-    if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
-        return True
-    return False
-
-
 def backupLocalFile(webhdfs, path):
     #ext = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime(time.time()))
     ext = time.strftime("%Y-%m-%d_%H_%M_%S~", time.localtime(time.time()))
@@ -95,38 +88,273 @@ def backupLocalFile(webhdfs, path):
     os.rename(path, backupdest)
 
 
+class PartialFile:
+    """
+    A file downloaded by ranges, by several threads. The one getting the last range complete it, or just close it if
+    a range failed. verification and remote (its HDFS checksum) are None if not verified.
+    """
+    def __init__(self, f, localFile, nbrRanges, verification, remote):
+        self.f = f
+        self.localFile = localFile
+        self.verification = verification
+        self.remote = remote
+        self.remaining = nbrRanges
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def rangeDone(self):
+        """ Return True if all ranges are downloaded """
+        with self.lock:
+            self.remaining -= 1
+            return self.remaining == 0
+
+
 class PutThread(Thread):
-    def __init__(self, tid, queue, srcTree, destTree, webHDFS, p):
+    def __init__(self, tid, queue, srcTree, destTree, webHDFS, verifier, limiter, p):
         Thread.__init__(self)
         self.tid = tid
         self.queue = queue
         self.srcTree = srcTree
         self.destTree = destTree
         self.webHDFS = webHDFS
+        self.verifier = verifier
+        self.limiter = limiter
         self.p = p
         self.fileCount = 0;
+        self.byteCount = 0
+        self.lastFileTime = None
+        self.errorCount = 0
+        self.mismatched = []
     
     def run(self):
         tlogger.debug("Thread#{0} started".format(self.tid))
         while True:
-            try:
-                f = self.queue.get_nowait()
-            except Queue.Empty:
+            f = self.queue.get()
+            if f == None:
                 tlogger.debug("Thread#{0} ended. {1} files handled".format(self.tid, self.fileCount))
                 return
-            srcPath = os.path.join(self.srcTree['rroot'], f)
-            destPath = os.path.join(self.destTree['rroot'], f)
-            if f in self.destTree['files'] and self.p.backup:
-                backupLocalFile(self.webHDFS, destPath)
-            self.webHDFS.getFileFromHdfs(srcPath, destPath, self.p.force)
-            modTime = self.srcTree['files'][f]['modificationTime']
-            os.utime(destPath, (time.time(), modTime))
-            applyAttrOnNewFile(destPath, self.p)
-            self.fileCount += 1
+            transferred = 0
+            try:
+                with self.limiter:
+                    if type(f) is tuple:
+                        transferred = self.getRange(*f)
+                    else:
+                        transferred = self.getFile(f)
+            except (Exception, SystemExit) as e:
+                # Retries exhausted, or not retriable. Go on with other files (SystemExit: Already printed by misc.ERROR())
+                self.errorCount += 1
+                tlogger.error("Thread#{0}: '{1}' not copied{2}".format(self.tid, f[0].f if type(f) is tuple else f, "" if isinstance(e, SystemExit) else ": {0}".format(e)))
+            finally:
+                # Even on error, so the datanode stream slot is not lost
+                self.queue.release(transferred)
+
+    def getFile(self, f):
+        """ Return the number of bytes transferred. 0 if split in ranges """
+        srcPath = os.path.join(self.srcTree['rroot'], f)
+        destPath = os.path.join(self.destTree['rroot'], f)
+        blocks = self.queue.takeBlocks(f)
+        # A copy again, after a checksum mismatch, replaces our own copy
+        retry = self.verifier != None and self.verifier.isRetry(f)
+        if f in self.destTree['files'] and self.p.backup and not retry:
+            backupLocalFile(self.webHDFS, destPath)
+        if os.path.exists(destPath) and not self.p.force and not retry:
+            misc.ERROR("Local file {0} already exists. Will not overwrite it!".format(destPath))
+        size = self.srcTree['files'][f]['size']
+        partSize = common.getPartSize(size, self.p)
+        (verification, remote) = (None, None)
+        if self.verifier != None and size > 0:
+            # Checksum parameters are needed before the transfer
+            remote = self.verifier.remoteChecksum(self.webHDFS, srcPath)
+            if remote != None:
+                (bytesPerCrc, crcPerBlock, crcType, _) = remote
+                verification = checksum.Verification(bytesPerCrc, crcPerBlock * bytesPerCrc if crcPerBlock > 0 else None, crcType, size, min(partSize, size))
+        localFile = fastio.LocalFile(destPath, size)
+        if partSize < size:
+            self.splitFile(f, localFile, size, partSize, blocks, verification, remote)
+            return 0
+        try:
+            self.webHDFS.getFileFromHdfs(srcPath, localFile, self.queue.datanode(), verification.digest(0) if verification != None else None)
+        except:
+            localFile.close()
+            raise
+        self.byteCount += size
+        self.complete(f, localFile, verification, remote)
+        return size
+
+    def splitFile(self, f, localFile, size, partSize, blocks, verification, remote):
+        """ Queue the ranges of an allocated file. They will be served before other files, to all threads """
+        offsets = range(0, size, partSize)
+        partialFile = PartialFile(f, localFile, len(offsets), verification, remote)
+        tlogger.debug("Thread#{0}: {1} split in {2} ranges".format(self.tid, f, len(offsets)))
+        for offset in offsets:
+            hosts = scheduler.hostsAt(blocks, offset) if blocks != None else None
+            self.queue.putPart((partialFile, offset, min(partSize, size - offset)), hosts)
+
+    def getRange(self, partialFile, offset, length):
+        srcPath = os.path.join(self.srcTree['rroot'], partialFile.f)
+        digest = partialFile.verification.digest(offset) if partialFile.verification != None else None
+        try:
+            self.webHDFS.getRangeFromHdfs(srcPath, partialFile.localFile, offset, length, self.queue.datanode(), digest)
+        except:
+            partialFile.failed = True
+            raise
+        finally:
+            last = partialFile.rangeDone()
+            if last and partialFile.failed:
+                partialFile.localFile.close()
+        self.byteCount += length
+        if last and not partialFile.failed:
+            self.complete(partialFile.f, partialFile.localFile, partialFile.verification, partialFile.remote)
+        return length
+
+    def complete(self, f, localFile, verification, remote):
+        """
+        Set times and attributes through the still open file, then close it
+        With --verify, the file is first checked against its HDFS checksum. On mismatch, it is queued again (up to
+        checksum.MAX_ATTEMPTS copies). Its modification time is not set, so a given up file is copied again by next run.
+        """
+        try:
+            matches = verification == None or self.verifier.verify(f, localFile.path, verification, remote)
+            if matches:
+                modTime = self.srcTree['files'][f]['modificationTime']
+                localFile.setTimes(time.time(), modTime)
+                applyAttrOnNewFile(localFile, self.p)
+        finally:
+            localFile.close()
+        if not matches:
+            again = self.verifier.failed(f)
+            self.mismatched.append((f, again))
+            if again:
+                self.queue.put(f)
+            return
+        self.fileCount += 1
+        self.lastFileTime = time.time()
+
+
+def copyTree(directoriesToCreate, files, nbrFiles, srcTree, destTree, p):
+    """ 
+    Create directories and copy files.
+    Only leaf directories are created, in parallel. Files are queued for copy as soon as their directory exists.
+    """
+    if len(directoriesToCreate) == 0 and nbrFiles == 0:
+        return
+    createdBy = planner.planDirectoryCreation(directoriesToCreate)
+    leafOf = {}
+    for (leaf, dirs) in createdBy.iteritems():
+        for d in dirs:
+            leafOf[d] = leaf
+    if p.nbrProcesses > 1:
+        # Copy threads and their scheduler are in each process. Files are sent to them
+        copiers = processes.CopyProcesses(p.nbrProcesses, srcTree['files'], lambda: startCopyInProcess(srcTree, destTree, p), lambda: endCopyInProcess(p))
+        queue = copiers
+        getThreads = copiers.shards
+    else:
+        queue = newScheduler(srcTree, p)
+    waiting = {}
+    sizes = array('l')
+    for f in files:
+        size = srcTree['files'][f]['size']
+        if p.nbrProcesses > 1:
+            sizes.append(size)  # Parts of a file are all copied by its process
+        else:
+            sizes.extend(scheduler.transferSizes(size, common.getPartSize(size, p)))
+        leaf = leafOf.get(os.path.dirname(os.path.join(destTree['rroot'], f)))
+        if leaf == None:
+            queue.put(f)
+        else:
+            waiting.setdefault(leaf, []).append(f)
+    if p.nbrProcesses <= 1:
+        getThreads = startGetThreads(queue, srcTree, destTree, p)
+    st = common.StatsThread(getThreads, nbrFiles)
+    if nbrFiles > 0:
+        st.start()
+    dirPool = common.WorkerPool(p.nbrThreads, "mkdirs")
+    for leaf in sorted(createdBy):
+        dirPool.submit(createDirectory, leaf, createdBy[leaf], waiting.pop(leaf, []), queue, p)
+    errors = 0
+    try:
+        dirPool.join()
+    finally:
+        if p.nbrProcesses > 1:
+            errors = copiers.join()
+        else:
+            for _ in getThreads:
+                queue.put(None)
+            for t in getThreads:
+                t.join()
+            errors = sum(t.errorCount for t in getThreads)
+        st.stop()
+        if nbrFiles > 0:
+            st.join()
+    if p.nbrProcesses <= 1 and not queue.empty():
+        misc.ERROR("File Queue not empty while all threads ending!!")
+    if p.report and nbrFiles > 0:
+        if p.nbrProcesses > 1:
+            scheduler.printReport(getThreads, sizes, "process", "processes")
+        else:
+            scheduler.printReport(getThreads, sizes)
+        if p.datanodeStreams != None and p.nbrProcesses <= 1:
+            queue.printReport()
+    givenUp = checksum.printMismatches(getThreads, destTree['rroot'])
+    if errors > 0:
+        misc.ERROR("{0} copy errors", errors)
+    if givenUp > 0:
+        misc.ERROR("{0} files still not matching their HDFS checksum after {1} copies", givenUp, checksum.MAX_ATTEMPTS)
+
+
+def newScheduler(srcTree, p):
+    if p.datanodeStreams != None:
+        locate = lambda f: webHDFS.getFileBlockLocations(os.path.join(srcTree['rroot'], f))
+        return scheduler.DatanodeScheduler(srcTree['files'], locate, p.datanodeStreams)
+    else:
+        return scheduler.Scheduler(srcTree['files'])
+
+
+def startGetThreads(queue, srcTree, destTree, p):
+    getThreads = []
+    verifier = checksum.Verifier() if p.verify else None
+    limiter = concurrency.limiterOf(controller, "copy")
+    for i in range(0, p.nbrThreads):
+        pt = PutThread(i, queue, srcTree, destTree, webHDFS, verifier, limiter, p)
+        getThreads.append(pt)
+        pt.start()
+    if controller != None:
+        controller.follow(getThreads)
+    return getThreads
+
+
+copyQueue = None
+
+def startCopyInProcess(srcTree, destTree, p):
+    """ In a copy process: Own HTTP connections and queue """
+    global webHDFS, controller, copyQueue
+    webHDFS = webHDFS.clone()
+    controller = concurrency.lookup(p, webHDFS)
+    copyQueue = newScheduler(srcTree, p)
+    return (copyQueue, startGetThreads(copyQueue, srcTree, destTree, p))
+
+def endCopyInProcess(p):
+    if p.report and p.datanodeStreams != None:
+        # Streams per datanode are bounded in each process. So is this report
+        copyQueue.printReport()
+
+
+def createDirectory(leaf, dirs, files, queue, p):
+    """ Create leaf directory, with its missing parents (dirs). Then queue the files to copy in them """
+    if p.directoryMode != None:
+        os.makedirs(leaf, int(p.directoryMode, 8))
+    else:
+        os.makedirs(leaf)
+    for d in dirs:
+        applyAttrOnNewDirectory(d, p)
+    for f in files:
+        queue.put(f)
 
 
 # To be sure we cancel kerberos delegation token, if any
 webHDFS = None
+# --adaptive
+controller = None
 
 def cleanup():
     if webHDFS != None:
@@ -138,6 +366,7 @@ atexit.register(cleanup)
 def main():
     mydir =  os.path.dirname(os.path.realpath(__file__)) 
     p = common.parseArg(mydir)
+    engine.setup(p)
 
     if not p.src.startswith("/"):
         misc.ERROR("src '{0}' is not absolute. Absolute path is required for HDFS!", p.path)
@@ -148,8 +377,9 @@ def main():
         p.report = True
     
        
-    global webHDFS
+    global webHDFS, controller
     webHDFS = WebHDFS.lookup(p)
+    controller = concurrency.lookup(p, webHDFS)
 
     
     (ft, _) = webHDFS.getPathTypeAndStatus(p.src)
@@ -162,63 +392,51 @@ def main():
     elif ft != "DIRECTORY":
         misc.ERROR("HDFS path {0}: Unknown type: '{1}'", p.src, ft)
 
-    srcTree = buildTree.buildHdfsTree(webHDFS, p.src)
-    
     if not os.path.exists(p.dest):
         misc.ERROR("Path {0} non existing locally", p.dest)
     if not os.path.isdir(p.dest):
         misc.ERROR("Path {0} is not a directory", p.dest)
     
-    directoriesToCreate = []
-    directoriesToAdjust = []
-    filesToCreate = []
-    filesToReplace = []
-    filesToAdjust = []
+    plan = planner.newPlan(p)
+    directoriesToCreate = plan['directoriesToCreate']
+    directoriesToAdjust = plan['directoriesToAdjust']
+    filesToCreate = plan['filesToCreate']
+    filesToReplace = plan['filesToReplace']
+    filesToAdjust = plan['filesToAdjust']
 
     # If source does not end with '/', its basename will be added to target path. And directory created if not existing
-    if not srcTree['slashTerminated']:
-        x = os.path.basename(srcTree['rroot'])
+    # Local target is walked first, as it may be used to prune the HDFS walk.
+    checksums = None
+    if p.src == "/" or not p.src.endswith("/"):
+        x = os.path.basename(p.src)
         p.dest = os.path.join(p.dest, x)
         if not os.path.isdir(p.dest):
             directoriesToCreate.append(p.dest)
             destTree = buildTree.buildEmptyTree(p.dest)
         else:
-            destTree = buildTree.buildLocalTree(p.dest)
+            checksums = checksumCache.lookup(p, p.dest)
+            destTree = buildTree.buildLocalTree(p.dest, p.nbrListingThreads, checksums)
             dirStatus = buildTree.getLocalPathStatus(p.dest)
             destTree['directories'][p.dest] = dirStatus  # Will need to to apply modification later on
-            if checkAttrOnExistingDir(dirStatus, p):
+            if planner.checkAttrOnExistingDir(dirStatus, p):
                 directoriesToAdjust.append(p.dest)
     else:
-        destTree = buildTree.buildLocalTree( p.dest)
-    
+        checksums = checksumCache.lookup(p, p.dest)
+        destTree = buildTree.buildLocalTree(p.dest, p.nbrListingThreads, checksums)
+
+    cache = listingCache.lookup(p, webHDFS, p.src)
+    srcTree = buildTree.buildHdfsTree(webHDFS, p.src, p.nbrListingThreads, cache, pruner.lookup(p, webHDFS, destTree))
+    if cache != None:
+        cache.close()
 
     if logger.getEffectiveLevel() <= logging.DEBUG:
         logger.debug("Source (HDFS) files:\n" + misc.pprint2s(srcTree))
         logger.debug("Target (local) files:\n" + misc.pprint2s(destTree))
     
-    # Lookup all folder to create on target
-    for dirName in srcTree['directories']:
-        if dirName in destTree['directories']:
-            if checkAttrOnExistingDir(destTree['directories'][dirName], p):
-                directoriesToAdjust.append(dirName)
-        else:
-            dirPath = os.path.join(destTree['rroot'], dirName)
-            directoriesToCreate.append(dirPath)
-
-    directoriesToAdjust.sort()
-    directoriesToCreate.sort()
-
-    for fileName in srcTree['files']:
-        if fileName in destTree['files']:
-            srcFilesStatus = srcTree['files'][fileName]
-            destFilesStatus = destTree['files'][fileName]
-            if srcFilesStatus['size'] != destFilesStatus['size'] or srcFilesStatus['modificationTime'] != destFilesStatus['modificationTime']:
-                filesToReplace.append(fileName)
-            elif checkAttrOnExistingFile(destTree['files'][fileName], p):
-                filesToAdjust.append(fileName)
-        else:
-            filesToCreate.append(fileName)
-    
+    planner.buildPlan(plan, srcTree, destTree, p)
+    checksum.comparePlan(plan, srcTree, destTree, destTree['rroot'], srcTree['rroot'], webHDFS, checksums, p)
+    if checksums != None:
+        checksums.close()
     
     if(p.report):
         print("{0} files in {1} directories present in HDFS source".format(len(srcTree['files']), len(srcTree['directories'])))
@@ -261,12 +479,6 @@ def main():
     nbrOperations = len(directoriesToCreate) + len(filesToAdjust) + len(filesToCreate) + len(filesToReplace) + len(directoriesToAdjust)
 
     if not p.checkMode:
-        for f in directoriesToCreate:
-            if p.directoryMode != None:
-                os.mkdir(f, int(p.directoryMode, 8))
-            else:
-                os.mkdir(f)
-            applyAttrOnNewDirectory(f, p)
         if p.forceExt:
             for f in directoriesToAdjust:
                 dirPath = os.path.join(destTree['rroot'], f)
@@ -276,26 +488,14 @@ def main():
                 filePath = os.path.join(destTree['rroot'], f)
                 fileStatus = destTree['files'][f]
                 adjustAttrOnExistingFile(filePath, fileStatus, p)
-        if len(filesToCreate) > 0 or len(filesToReplace) > 0:
-            queue = Queue.Queue()
-            for f in filesToCreate:
-                queue.put(f)
-            if p.force:
-                for f in filesToReplace:
-                    queue.put(f)
-            myThreads = []
-            for i in range(0, p.nbrThreads):
-                pt = PutThread(i, queue, srcTree, destTree, webHDFS, p)
-                myThreads.append(pt)
-                pt.start()
-            st = common.StatsThread(queue, myThreads)
-            myThreads.append(st)
-            st.start()
-            for t in myThreads:
-                t.join()
-            if not queue.empty():
-                misc.ERROR("File Queue not empty while all threads ending!!")
+        if p.force:
+            copyTree(directoriesToCreate, itertools.chain(filesToCreate, filesToReplace), len(filesToCreate) + len(filesToReplace), srcTree, destTree, p)
+        else:
+            copyTree(directoriesToCreate, filesToCreate, len(filesToCreate), srcTree, destTree, p)
 
+    if p.report:
+        (opened, reused) = webHDFS.getConnectionStats()
+        print("{0} HTTP connections opened, {1} reused".format(opened, reused))
     print("Operation count: {0}".format(nbrOperations))
     return 0
 
@@ -24,10 +24,24 @@ import yaml
 import lib.WebHDFS as WebHDFS
 import lib.buildTree as buildTree
 import sys
-import Queue    
+import itertools
+from array import array
 from threading import Thread
 import time
 import lib.common as common
+import lib.planner as planner
+import lib.listingCache as listingCache
+import lib.pruner as pruner
+import lib.scheduler as scheduler
+import lib.engine as engine
+import lib.processes as processes
+import lib.checksum as checksum
+import lib.checksumCache as checksumCache
+import lib.concurrency as concurrency
+import lib.journal as journal
+import lib.inotify as inotify
+from lib.watcher import TreeWatcher
+import stat
 import atexit
 
 logger = logging.getLogger("hdfsput.main")
@@ -35,55 +49,52 @@ tlogger = logging.getLogger("hdfsput.thread")
 
 
 def applyAttrOnNewFile(webhdfs, path, p):
-    if p.owner != None:
-        webhdfs.setOwner(path,p.owner)
-    if p.group != None:
-        webhdfs.setGroup(path, p.group)
-    if p.mode != None:
-        webhdfs.setPermission(path, p.mode)
+    if p.owner != None or p.group != None:
+        webhdfs.setOwnerAndGroup(path, p.owner, p.group)
+    # Mode is defined at creation
 
 
 def applyAttrOnNewDirectory(webhdfs, path, p):
-    if p.owner != None:
-        webhdfs.setOwner(path, p.owner)
-    if p.group != None:
-        webhdfs.setGroup(path, p.group)
+    if p.owner != None or p.group != None:
+        webhdfs.setOwnerAndGroup(path, p.owner, p.group)
     # Mode is defined at creation
 
 def adjustAttrOnExistingFile(webhdfs, filePath, fileStatus, p):
-    if p.owner != None and p.owner != fileStatus['owner']:
-        webhdfs.setOwner(filePath, p.owner)
-    if p.group != None and p.group != fileStatus['group']:
-        webhdfs.setGroup(filePath, p.group)
+    owner = p.owner if p.owner != None and p.owner != fileStatus['owner'] else None
+    group = p.group if p.group != None and p.group != fileStatus['group'] else None
+    if owner != None or group != None:
+        webhdfs.setOwnerAndGroup(filePath, owner, group)
     if(p.mode != None and fileStatus['mode'] != p.mode):
         webhdfs.setPermission(filePath, p.mode)
 
 def adjustAttrOnExistingDir(webhdfs, dirPath, dirStatus, p):
-    if p.owner != None and p.owner != dirStatus['owner']:
-        webhdfs.setOwner(dirPath, p.owner)
-    if p.group != None and p.group != dirStatus['group']:
-        webhdfs.setGroup(dirPath, p.group)
+    owner = p.owner if p.owner != None and p.owner != dirStatus['owner'] else None
+    group = p.group if p.group != None and p.group != dirStatus['group'] else None
+    if owner != None or group != None:
+        webhdfs.setOwnerAndGroup(dirPath, owner, group)
     if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
         webhdfs.setPermission(dirPath, p.directoryMode)
 
+def setMetadataOnNewFile(webhdfs, path, modTime, p):
+    webhdfs.setModificationTime(path, modTime)
+    applyAttrOnNewFile(webhdfs, path, p)
+
+def setMetadataOnNewDirectory(webhdfs, path, fixPermission, p):
+    applyAttrOnNewDirectory(webhdfs, path, p)
+    if fixPermission:
+        webhdfs.setPermission(path, p.directoryMode)
+
+def journaled(runJournal, operation, path, fn, *args):
+    """ Run fn(*args). Then, with --journal, record the operation on path as done. Errors are logged here, as the metadata pool goes on with other operations """
+    try:
+        fn(*args)
+    except (Exception, SystemExit) as e:
+        # SystemExit: Already printed by misc.ERROR()
+        logger.error("'{0}': Attributes not set{1}".format(path, "" if isinstance(e, SystemExit) else ": {0}".format(e)))
+        raise
+    if runJournal != None:
+        runJournal.done(operation, path)
 
-def checkAttrOnExistingFile(fileStatus, p):
-    if p.owner != None and p.owner != fileStatus['owner']:
-        return True
-    if p.group != None and p.group != fileStatus['group']:
-        return True
-    if(p.mode != None and fileStatus['mode'] != p.mode):
-        return True
-    return False
-
-def checkAttrOnExistingDir(dirStatus, p):
-    if p.owner != None and p.owner != dirStatus['owner']:
-        return True
-    if p.group != None and p.group != dirStatus['group']:
-        return True
-    if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
-        return True
-    return False
 
 def backupHdfsFile(webhdfs, path):
     #ext = time.strftime("%Y-%m-%d@%H:%M:%S", time.localtime(time.time()))
@@ -93,124 +104,168 @@ def backupHdfsFile(webhdfs, path):
 
 
 class PutThread(Thread):
-    def __init__(self, tid, queue, srcTree, destTree, webHDFS, p):
+    def __init__(self, tid, queue, srcTree, destTree, webHDFS, metadataPool, verifier, limiter, partLimiter, runJournal, p):
         Thread.__init__(self)
         self.tid = tid
         self.queue = queue
+        self.metadataPool = metadataPool
+        self.runJournal = runJournal
         self.srcTree = srcTree
         self.destTree = destTree
         self.webHDFS = webHDFS
+        self.verifier = verifier
+        self.limiter = limiter
+        self.partLimiter = partLimiter
         self.p = p
         self.fileCount = 0;
+        self.byteCount = 0
+        self.lastFileTime = None
+        self.errorCount = 0
+        self.copied = []
+        self.mismatched = []
     
     def run(self):
         tlogger.debug("Thread#{0} started".format(self.tid))
         while True:
-            try:
-                f = self.queue.get_nowait()
-            except Queue.Empty:
+            f = self.queue.get()
+            if f == None:
                 tlogger.debug("Thread#{0} ended. {1} files handled".format(self.tid, self.fileCount))
                 return
-            srcPath = os.path.join(self.srcTree['rroot'], f)
-            destPath = os.path.join(self.destTree['rroot'], f)
-            if f in self.destTree['files'] and self.p.backup:
-                backupHdfsFile(self.webHDFS, destPath)
-            self.webHDFS.putFileToHdfs(srcPath, destPath, self.p.force)
-            modTime = self.srcTree['files'][f]['modificationTime']
-            self.webHDFS.setModificationTime(destPath, modTime)
-            applyAttrOnNewFile(self.webHDFS, destPath, self.p)
-            self.fileCount += 1
+            with self.limiter:
+                try:
+                    self.putFile(f)
+                except (Exception, SystemExit) as e:
+                    # Retries exhausted, or not retriable. Go on with other files (SystemExit: Already printed by misc.ERROR())
+                    self.errorCount += 1
+                    tlogger.error("Thread#{0}: '{1}' not copied{2}".format(self.tid, f, "" if isinstance(e, SystemExit) else ": {0}".format(e)))
+
+    def putFile(self, f):
+        srcPath = os.path.join(self.srcTree['rroot'], f)
+        destPath = os.path.join(self.destTree['rroot'], f)
+        # A copy again, after a checksum mismatch, replaces our own copy. As may a resumed one (--resume)
+        retry = self.verifier != None and self.verifier.isRetry(f)
+        overwrite = self.p.force or retry or self.p.resume
+        if f in self.destTree['files'] and self.p.backup and not retry and not (self.runJournal != None and f in self.runJournal.backedUp):
+            backupHdfsFile(self.webHDFS, destPath)
+            if self.runJournal != None:
+                self.runJournal.backup(f)
+        size = self.srcTree['files'][f]['size']
+        partSize = common.getPartSize(size, self.p)
+        verification = None
+        if self.verifier != None and size > 0:
+            verification = checksum.Verification(checksum.DEFAULT_BYTES_PER_CRC, self.p.blockSize, checksum.DEFAULT_CRC_TYPE, size, min(partSize, size))
+        if partSize < size:
+            self.webHDFS.putFileToHdfsByParts(srcPath, destPath, overwrite, self.p.mode, size, partSize, self.p.blockSize, self.nbrPartThreads(), self.partLimiter, verification)
+        else:
+            self.webHDFS.putFileToHdfs(srcPath, destPath, overwrite, self.p.mode, verification.digest(0) if verification != None else None)
+        self.byteCount += size
+        if verification != None and not self.verify(f, srcPath, destPath, verification):
+            return
+        modTime = self.srcTree['files'][f]['modificationTime']
+        # Don't wait for metadata update. Go to next file
+        self.metadataPool.submit(journaled, self.runJournal, "file", f, setMetadataOnNewFile, self.webHDFS, destPath, modTime, self.p)
+        self.fileCount += 1
+        self.lastFileTime = time.time()
+        self.copied.append(f)
+
+    def nbrPartThreads(self):
+        """ Parts of a file are not under the copy limiter, but under the part one, shared by all threads of the process """
+        return self.limiter.limit if self.limiter.limit != None else self.p.nbrThreads
+
+    def verify(self, f, srcPath, destPath, verification):
+        """
+        Check the copy of f against its HDFS checksum. On mismatch, queue it again (up to checksum.MAX_ATTEMPTS copies).
+        Its modification time is not set, so a given up file is copied again by next run.
+        """
+        remote = self.verifier.remoteChecksum(self.webHDFS, destPath)
+        if remote == None or self.verifier.verify(f, srcPath, verification, remote):
+            return True
+        again = self.verifier.failed(f)
+        self.mismatched.append((f, again))
+        if again:
+            self.queue.put(f)
+        return False
             
             
             
 # To be sure we cancel kerberos delegation token, if any
 webHDFS = None
+# --adaptive
+controller = None
+# --journal. Records written on exit, even on error
+runJournal = None
 
 def cleanup():
     if webHDFS != None:
         webHDFS.close()
+    if runJournal != None:
+        runJournal.close()
 
 atexit.register(cleanup)
 
 
-def main():
-    mydir =  os.path.dirname(os.path.realpath(__file__)) 
-    p = common.parseArg(mydir)
-
-    if not p.dest.startswith("/"):
-        misc.ERROR("dest '{0}' is not absolute. Absolute path is required for HDFS!", p.path)
-        
-    logging.config.dictConfig(yaml.load(open(p.loggingConfFile)))
-       
-    global webHDFS
-    webHDFS = WebHDFS.lookup(p)
-
-    if not os.path.isdir(p.src):
-        misc.ERROR("{0} must be an existing folder".format(p.src))
-    srcTree = buildTree.buildLocalTree(p.src)
-    
-    (ft, _) = webHDFS.getPathTypeAndStatus(p.dest)
-    if ft == "NOT_FOUND":
-        misc.ERROR("Path {0} non existing on HDFS", p.dest)
-    if ft == "FILE":
-        misc.ERROR("HDFS path {0} is a file, not a directory", p.dest)
-    elif ft == "NO_ACCESS":
-        misc.ERROR("HDFS path {0}: No access", p.dest)
-    elif ft != "DIRECTORY":
-        misc.ERROR("HDFS path {0}: Unknown type: '{1}'", p.dest, ft)
+def buildMirrorPlan(p):
+    """ Walk and compare both trees. Return (srcTree, destTree, dest, plan, cache). dest: The HDFS target directory """
+    checksums = checksumCache.lookup(p, p.src)
+    srcTree = buildTree.buildLocalTree(p.src, p.nbrListingThreads, checksums)
+    treePruner = pruner.lookup(p, webHDFS, srcTree)
+    dest = p.dest
 
-    directoriesToCreate = []
-    directoriesToAdjust = []
-    filesToCreate = []
-    filesToReplace = []
-    filesToAdjust = []
+    plan = planner.newPlan(p)
+    directoriesToCreate = plan['directoriesToCreate']
+    directoriesToAdjust = plan['directoriesToAdjust']
 
     # If source does not end with '/', its basename will be added to target path. And directory created if not existing
+    cache = None
     if not srcTree['slashTerminated']:
         x = os.path.basename(srcTree['rroot'])
-        p.dest = os.path.join(p.dest, x)
-        (ft, dirStatus) = webHDFS.getPathTypeAndStatus(p.dest)
+        dest = os.path.join(dest, x)
+        (ft, dirStatus) = webHDFS.getPathTypeAndStatus(dest)
         if ft == "NOT_FOUND":
-            directoriesToCreate.append(p.dest)
-            destTree = buildTree.buildEmptyTree(p.dest)
+            directoriesToCreate.append(dest)
+            destTree = buildTree.buildEmptyTree(dest)
         elif ft == "DIRECTORY":
-            destTree = buildTree.buildHdfsTree(webHDFS, p.dest)
-            destTree['directories'][p.dest] = dirStatus  # Will need to to apply modification later on
-            if checkAttrOnExistingDir(dirStatus, p):
-                directoriesToAdjust.append(p.dest)
+            cache = listingCache.lookup(p, webHDFS, dest)
+            destTree = buildTree.buildHdfsTree(webHDFS, dest, p.nbrListingThreads, cache, treePruner)
+            destTree['directories'][dest] = dirStatus  # Will need to to apply modification later on
+            if planner.checkAttrOnExistingDir(dirStatus, p):
+                directoriesToAdjust.append(dest)
         else:
-            misc.ERROR("HDFS path {0}: Invalid type: '{1}'", p.dest, ft)
+            misc.ERROR("HDFS path {0}: Invalid type: '{1}'", dest, ft)
     else:
-        destTree = buildTree.buildHdfsTree(webHDFS, p.dest)
+        cache = listingCache.lookup(p, webHDFS, dest)
+        destTree = buildTree.buildHdfsTree(webHDFS, dest, p.nbrListingThreads, cache, treePruner)
     
 
     if logger.getEffectiveLevel() <= logging.DEBUG:
         logger.debug("Source (local) files:\n" + misc.pprint2s(srcTree))
         logger.debug("Target (HDFS) files:\n" + misc.pprint2s(destTree))
 
-    # Lookup all folder to create or adjust on target
-    for dirName in srcTree['directories']:
-        if dirName in destTree['directories']:
-            if checkAttrOnExistingDir(destTree['directories'][dirName], p):
-                directoriesToAdjust.append(dirName)
-        else:
-            dirPath = os.path.join(destTree['rroot'], dirName)
-            directoriesToCreate.append(dirPath)
-
-    directoriesToAdjust.sort()
-    directoriesToCreate.sort()
-
-    for fileName in srcTree['files']:
-        if fileName in destTree['files']:
-            srcFilesStatus = srcTree['files'][fileName]
-            destFilesStatus = destTree['files'][fileName]
-            if srcFilesStatus['size'] != destFilesStatus['size'] or srcFilesStatus['modificationTime'] != destFilesStatus['modificationTime']:
-                filesToReplace.append(fileName)
-            elif checkAttrOnExistingFile(destTree['files'][fileName], p):
-                filesToAdjust.append(fileName)
-        else:
-            filesToCreate.append(fileName)
+    planner.buildPlan(plan, srcTree, destTree, p)
+    checksum.comparePlan(plan, srcTree, destTree, srcTree['rroot'], destTree['rroot'], webHDFS, checksums, p)
+    if checksums != None:
+        checksums.close()
+    return (srcTree, destTree, dest, plan, cache)
+
 
+def mirror(p):
+    """ Full tree comparison and copy. Return (srcTree, destTree, nbrOperations). destTree is updated with the performed operations """
+    global runJournal
+    if p.resume:
+        # The plan of the interrupted run, minus the operations done
+        (runJournal, srcTree, destTree, dest, plan) = journal.resume(p)
+        cache = listingCache.lookup(p, webHDFS, dest)
+    else:
+        (srcTree, destTree, dest, plan, cache) = buildMirrorPlan(p)
+        runJournal = journal.lookup(p)
+        if runJournal != None:
+            runJournal.recordPlan(p, srcTree, destTree, dest, plan)
+    directoriesToCreate = plan['directoriesToCreate']
+    directoriesToAdjust = plan['directoriesToAdjust']
+    filesToCreate = plan['filesToCreate']
+    filesToReplace = plan['filesToReplace']
+    filesToAdjust = plan['filesToAdjust']
+    
     if(p.report):
         print("{0} files in {1} directories present in local source".format(len(srcTree['files']), len(srcTree['directories'])))
         print("{0} files in {1} directories already present in HDFS target".format(len(destTree['files']), len(destTree['directories'])))
@@ -251,43 +306,295 @@ def main():
     nbrOperations = len(directoriesToCreate) + len(filesToAdjust) + len(filesToCreate) + len(filesToReplace) + len(directoriesToAdjust)
 
     if not p.checkMode:
-        for f in directoriesToCreate:
-            webHDFS.createFolder(f, p.directoryMode)
-            applyAttrOnNewDirectory(webHDFS, f, p)
-        if p.forceExt:
+        # Owner, group, mode and modification time are set by a separate set of threads, in parallel with the files copy.
+        metadataPool = common.WorkerPool(p.nbrThreads, "metadata", concurrency.limiterOf(controller, "metadata"), True)
+        def adjust():
+            if not p.forceExt:
+                return
             for f in directoriesToAdjust:
                 dirPath = os.path.join(destTree['rroot'], f)
                 dirStatus = destTree['directories'][f]
-                adjustAttrOnExistingDir(webHDFS, dirPath, dirStatus, p)
+                metadataPool.submit(journaled, runJournal, "adjustDirectory", f, adjustAttrOnExistingDir, webHDFS, dirPath, dirStatus, p)
             for f in filesToAdjust:
                 filePath = os.path.join(destTree['rroot'], f)
                 fileStatus = destTree['files'][f]
-                adjustAttrOnExistingFile(webHDFS, filePath, fileStatus, p)
-        if len(filesToCreate) > 0 or len(filesToReplace) > 0:
-            queue = Queue.Queue()
-            for f in filesToCreate:
-                queue.put(f)
+                metadataPool.submit(journaled, runJournal, "adjustFile", f, adjustAttrOnExistingFile, webHDFS, filePath, fileStatus, p)
+            if cache != None:
+                # Attributes changes does not update the modification time of the parent directory.
+                for f in directoriesToAdjust:
+                    cache.invalidate(os.path.dirname(os.path.join(destTree['rroot'], f)))
+                for f in filesToAdjust:
+                    cache.invalidate(os.path.dirname(os.path.join(destTree['rroot'], f)))
+        try:
             if p.force:
-                for f in filesToReplace:
-                    queue.put(f)
-            myThreads = []
-            for i in range(0, p.nbrThreads):
-                pt = PutThread(i, queue, srcTree, destTree, webHDFS, p)
-                myThreads.append(pt)
-                pt.start()
-            st = common.StatsThread(queue, myThreads)
-            myThreads.append(st)
-            st.start()
-            for t in myThreads:
+                copyTree(directoriesToCreate, itertools.chain(filesToCreate, filesToReplace), len(filesToCreate) + len(filesToReplace), srcTree, destTree, metadataPool, p, adjust)
+            else:
+                copyTree(directoriesToCreate, filesToCreate, len(filesToCreate), srcTree, destTree, metadataPool, p, adjust)
+        finally:
+            # Even on copy errors, so files copied get their modification time
+            metadataPool.join()
+        if runJournal != None:
+            runJournal.record("end")
+            runJournal.close()
+        if p.watch:
+            # destTree will be the reference for next changes
+            for (d, dirStatus) in srcTree['directories'].iteritems():
+                if d not in destTree['directories']:
+                    destTree['directories'][d] = dirStatus
+            for ((prefix, name), fileStatus) in pruner.filterPruned(srcTree['files'].itersorted(), destTree.get('pruned', []), True):
+                destTree['files'][prefix + name] = fileStatus
+        
+    if cache != None:
+        cache.close()
+    return (srcTree, destTree, nbrOperations)
+
+
+def copyTree(directoriesToCreate, files, nbrFiles, srcTree, destTree, metadataPool, p, adjust=None):
+    """ 
+    Create directories and copy files. Then record copied files in destTree. 
+    Only leaf directories are created, in parallel. Files are queued for copy as soon as their directory exists.
+    adjust, if provided, is called once copy processes are forked (--nbrProcesses), to submit other tasks to metadataPool.
+    Otherwise, a metadata thread could hold a lock (i.e. of logging) at fork time, forever in the copy processes.
+    """
+    if len(directoriesToCreate) == 0 and nbrFiles == 0:
+        if adjust != None:
+            adjust()
+        return
+    createdBy = planner.planDirectoryCreation(directoriesToCreate)
+    leafOf = {}
+    for (leaf, dirs) in createdBy.iteritems():
+        for d in dirs:
+            leafOf[d] = leaf
+    if p.nbrProcesses > 1:
+        # Copy threads and their metadata pool are in each process. Files are sent to them
+        copiers = processes.CopyProcesses(p.nbrProcesses, srcTree['files'], lambda: startCopyInProcess(srcTree, destTree, p), endCopyInProcess)
+        queue = copiers
+        putThreads = copiers.shards
+    else:
+        queue = scheduler.Scheduler(srcTree['files'])
+    if adjust != None:
+        adjust()
+    waiting = {}
+    sizes = array('l')
+    for f in files:
+        # Parts of a file are all accounted to the thread (or process) which handle it
+        sizes.append(srcTree['files'][f]['size'])
+        leaf = leafOf.get(os.path.dirname(os.path.join(destTree['rroot'], f)))
+        if leaf == None:
+            queue.put(f)
+        else:
+            waiting.setdefault(leaf, []).append(f)
+    if p.nbrProcesses <= 1:
+        putThreads = startPutThreads(queue, srcTree, destTree, metadataPool, p)
+    st = common.StatsThread(putThreads, nbrFiles)
+    if nbrFiles > 0:
+        st.start()
+    dirPool = common.WorkerPool(p.nbrThreads, "mkdirs")
+    for leaf in sorted(createdBy):
+        dirPool.submit(createDirectory, leaf, createdBy[leaf], waiting.pop(leaf, []), queue, metadataPool, p)
+    errors = 0
+    try:
+        dirPool.join()
+    finally:
+        if p.nbrProcesses > 1:
+            errors = copiers.join()
+        else:
+            for _ in putThreads:
+                queue.put(None)
+            for t in putThreads:
                 t.join()
-            if not queue.empty():
-                misc.ERROR("File Queue not empty while all threads ending!!")
+            errors = sum(t.errorCount for t in putThreads)
+        st.stop()
+        if nbrFiles > 0:
+            st.join()
+    if p.nbrProcesses <= 1 and not queue.empty():
+        misc.ERROR("File Queue not empty while all threads ending!!")
+    if p.report and nbrFiles > 0:
+        if p.nbrProcesses > 1:
+            scheduler.printReport(putThreads, sizes, "process", "processes")
+        else:
+            scheduler.printReport(putThreads, sizes)
+    for pt in putThreads:
+        for f in pt.copied:
+            destTree['files'][f] = srcTree['files'][f]
+    givenUp = checksum.printMismatches(putThreads, destTree['rroot'])
+    if errors > 0:
+        misc.ERROR("{0} copy errors", errors)
+    if givenUp > 0:
+        misc.ERROR("{0} files still not matching their HDFS checksum after {1} copies", givenUp, checksum.MAX_ATTEMPTS)
+
+
+def startPutThreads(queue, srcTree, destTree, metadataPool, p):
+    putThreads = []
+    verifier = checksum.Verifier() if p.verify else None
+    limiter = concurrency.limiterOf(controller, "copy")
+    # Bound the part uploads of all files together. Otherwise, each thread could run nbrThreads of them
+    partLimiter = concurrency.limiterOf(controller, "parts", p.nbrThreads)
+    for i in range(0, p.nbrThreads):
+        pt = PutThread(i, queue, srcTree, destTree, webHDFS, metadataPool, verifier, limiter, partLimiter, runJournal, p)
+        putThreads.append(pt)
+        pt.start()
+    if controller != None:
+        controller.follow(putThreads)
+    return putThreads
+
+
+copyMetadataPool = None
+
+def startCopyInProcess(srcTree, destTree, p):
+    """ In a copy process: Own HTTP connections, queue, metadata pool and journal descriptor """
+    global webHDFS, controller, copyMetadataPool, runJournal
+    webHDFS = webHDFS.clone()
+    controller = concurrency.lookup(p, webHDFS)
+    if runJournal != None:
+        runJournal = runJournal.clone()
+    copyMetadataPool = common.WorkerPool(p.nbrThreads, "metadata", concurrency.limiterOf(controller, "metadata"), True)
+    queue = scheduler.Scheduler(srcTree['files'])
+    return (queue, startPutThreads(queue, srcTree, destTree, copyMetadataPool, p))
+
+def endCopyInProcess():
+    copyMetadataPool.join()
+    if runJournal != None:
+        runJournal.close()
+
+
+def createDirectory(leaf, dirs, files, queue, metadataPool, p):
+    """ Create leaf directory, with its missing parents (dirs). Then queue the files to copy in them """
+    webHDFS.createFolder(leaf, p.directoryMode)
+    # HDFS add u+wx to the permission of the parents it creates
+    fixParents = p.directoryMode != None and (int(p.directoryMode, 8) & 0300) != 0300
+    for d in dirs:
+        metadataPool.submit(journaled, runJournal, "mkdir", d, setMetadataOnNewDirectory, webHDFS, d, fixParents and d != leaf, p)
+    for f in files:
+        queue.put(f)
+
+
+def watch(p):
+    """ 
+    Initial full mirror, then copy changes as they are notified by inotify. 
+    Fall back to periodic full mirrors if inotify is not available, or on too many directories.
+    """
+    watcher = None
+    if inotify.HAS_INOTIFY:
+        try:
+            watcher = TreeWatcher(p.src)
+        except OSError as e:
+            logger.warning("Unable to watch {0} ({1}). Will rescan every {2}s".format(p.src, e, p.rescanPeriod))
+    else:
+        logger.warning("inotify not available. Will rescan {0} every {1}s".format(p.src, p.rescanPeriod))
+    full = True     # A full mirror is needed: At start, on lost events, and after an error
+    started = False
+    while True:
+        try:
+            if full:
+                full = False
+                (srcTree, destTree, nbrOperations) = mirror(p)
+            elif watcher == None:
+                time.sleep(p.rescanPeriod)
+                (srcTree, destTree, nbrOperations) = mirror(p)
+            else:
+                try:
+                    batch = watcher.next(p.debounce)
+                except OSError as e:
+                    logger.warning("Unable to watch {0} ({1}). Will rescan every {2}s".format(p.src, e, p.rescanPeriod))
+                    watcher.close()
+                    watcher = None
+                    continue
+                if batch['overflow']:
+                    (srcTree, destTree, nbrOperations) = mirror(p)
+                else:
+                    nbrOperations = mirrorChanges(batch, srcTree, destTree, p)
+        except (Exception, SystemExit) as e:
+            # Keep watching. Changes of the failed batch are caught up by a full mirror (SystemExit: Already printed by misc.ERROR())
+            logger.error("Mirror failed{0}. Will mirror {1} again in {2}s".format("" if isinstance(e, SystemExit) else ": {0}".format(e), p.src, p.rescanPeriod))
+            full = True
+            time.sleep(p.rescanPeriod)
+            continue
+        if nbrOperations > 0 or not started:
+            print("Operation count: {0}".format(nbrOperations))
+        started = True
+
+
+def mirrorChanges(batch, srcTree, destTree, p):
+    """ Copy the files and directories of a batch from TreeWatcher. Return the number of operations """
+    directoriesToCreate = set()
+    filesToPut = []
+    for path in sorted(batch['directories'] | batch['files']):
+        try:
+            st = os.stat(os.path.join(srcTree['rroot'], path))
+        except OSError:
+            continue    # Already removed
+        parent = os.path.dirname(path)
+        if parent != "" and parent not in destTree['directories']:
+            directoriesToCreate.add(parent)
+        if stat.S_ISDIR(st.st_mode):
+            if path not in destTree['directories']:
+                directoriesToCreate.add(path)
+        elif stat.S_ISREG(st.st_mode):
+            srcStatus = buildTree.statToEntry(st, True)
+            srcTree['files'][path] = srcStatus
+            destStatus = destTree['files'].get(path)
+            if destStatus == None:
+                filesToPut.append(path)
+            elif srcStatus['size'] != destStatus['size'] or srcStatus['modificationTime'] != destStatus['modificationTime']:
+                if p.force:
+                    filesToPut.append(path)
+                else:
+                    logger.warning("{0} differs from source in HDFS target (use --force [--backup] to overwrite)".format(os.path.join(destTree['rroot'], path)))
+    metadataPool = common.WorkerPool(p.nbrThreads, "metadata", concurrency.limiterOf(controller, "metadata"), True)
+    try:
+        copyTree([ os.path.join(destTree['rroot'], d) for d in directoriesToCreate ], filesToPut, len(filesToPut), srcTree, destTree, metadataPool, p)
+    finally:
+        metadataPool.join()
+    for d in directoriesToCreate:
+        try:
+            dirStatus = buildTree.statToEntry(os.stat(os.path.join(srcTree['rroot'], d)), False)
+        except OSError:
+            continue
+        srcTree['directories'][d] = dirStatus
+        destTree['directories'][d] = dirStatus
+    return len(directoriesToCreate) + len(filesToPut)
+
+
+def main():
+    mydir =  os.path.dirname(os.path.realpath(__file__)) 
+    p = common.parseArg(mydir)
+    engine.setup(p)
+
+    if not p.dest.startswith("/"):
+        misc.ERROR("dest '{0}' is not absolute. Absolute path is required for HDFS!", p.path)
         
+    logging.config.dictConfig(yaml.load(open(p.loggingConfFile)))
+       
+    global webHDFS, controller
+    webHDFS = WebHDFS.lookup(p)
+    controller = concurrency.lookup(p, webHDFS)
+
+    if not os.path.isdir(p.src):
+        misc.ERROR("{0} must be an existing folder".format(p.src))
+    (ft, _) = webHDFS.getPathTypeAndStatus(p.dest)
+    if ft == "NOT_FOUND":
+        misc.ERROR("Path {0} non existing on HDFS", p.dest)
+    if ft == "FILE":
+        misc.ERROR("HDFS path {0} is a file, not a directory", p.dest)
+    elif ft == "NO_ACCESS":
+        misc.ERROR("HDFS path {0}: No access", p.dest)
+    elif ft != "DIRECTORY":
+        misc.ERROR("HDFS path {0}: Unknown type: '{1}'", p.dest, ft)
+
+    if p.watch:
+        if p.checkMode:
+            misc.ERROR("--watch and --checkMode are mutually exclusive")
+        watch(p)
+        return 0
+
+    nbrOperations = mirror(p)[2]
+    
+    if p.report:
+        (opened, reused) = webHDFS.getConnectionStats()
+        print("{0} HTTP connections opened, {1} reused".format(opened, reused))
     print("Operation count: {0}".format(nbrOperations))
     return 0
 
 if __name__ == '__main__':
     sys.exit(main())
-
-    
-    
\ No newline at end of file
@@ -15,10 +15,21 @@
 
 
 import os
+import copy
+import time
+import random
+import socket
+import urllib
+import httplib
+from urlparse import urlparse
 from xml.dom import minidom
-import misc
 import requests
+from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
+import misc
 import logging
+from sessionPool import SessionPool
+from common import WorkerPool
+import fastio
 
 logger = logging.getLogger("hdfsmirror.WebHDFS")
 
@@ -30,12 +41,42 @@ try:
 except ImportError:
     pass
 
+HAS_IJSON = False
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+    try:
+        import ijson.backends.yajl2_c as ijson  # Much faster, when available
+    except ImportError:
+        pass
+    HAS_IJSON = True
+except ImportError:
+    pass
+
+"""
+Failing requests (connection error, timeout, truncated response or 5xx) are retried up to 'retries' times, after a
+random delay up to RETRY_BASE * 2^attempt seconds (capped to RETRY_CAP): Exponential backoff with full jitter, so
+threads hit by the same hiccup don't come back all together.
+
+A request with a streamed body can't be sent again. So an interrupted upload is continued by APPEND, from the length
+reached by the HDFS file. And an interrupted download is resumed by OPEN from the last byte written.
+"""
+
+RETRIABLE = (requests.exceptions.RequestException, socket.error, httplib.HTTPException, Urllib3Error)
+RETRY_BASE = 1.0
+RETRY_CAP = 60.0
 
 
 class WebHDFS:
     
-    def __init__(self, endpoint, hdfsUser):
+    def __init__(self, endpoint, hdfsUser, poolSize=1, chunkSize=1048576, retries=0, timeout=None):
         self.endpoint = endpoint
+        self.chunkSize = chunkSize
+        self.retries = retries
+        self.timeout = timeout
+        self.blockLocations = True
+        self.pool = SessionPool(poolSize)
+        self.batchListing = True
         self.delegationToken = None
         self.auth = None
         if hdfsUser == "KERBEROS":
@@ -52,7 +93,7 @@ class WebHDFS:
             if self.kerberos:
                 kerberos_auth = HTTPKerberosAuth()
                 url = "http://{0}/webhdfs/v1/?op=GETDELEGATIONTOKEN".format(self.endpoint)
-                resp = requests.get(url, auth=kerberos_auth)
+                resp = self.httpGet(url, auth=kerberos_auth, retries=0)
                 logger.debug(url + " -> " + str(resp.status_code)) 
                 if resp.status_code == 200:
                     result = resp.json()
@@ -65,7 +106,7 @@ class WebHDFS:
                     return (False, "{0}  =>  Response code: {1}".format(url, resp.status_code))
             else:
                 url = "http://{0}/webhdfs/v1/?{1}op=GETFILESTATUS".format(self.endpoint, self.auth)
-                resp = requests.get(url)
+                resp = self.httpGet(url, retries=0)
                 logger.debug(url + " -> " + str(resp.status_code)) 
                 if resp.status_code == 200:
                     return (True, "")
@@ -80,24 +121,76 @@ class WebHDFS:
                 return (False, "{0}  =>  Error: {1}".format(url, str(e)))
 
 
+    def clone(self):
+        """ 
+        Return a copy with its own connections pool, for a forked process. Its close() will not cancel the delegation
+        token, which is still owned by this one.
+        """
+        other = copy.copy(self)
+        other.pool = SessionPool(self.pool.size)
+        other.delegationToken = None
+        return other
+
     def close(self):
         if self.kerberos and self.delegationToken != None:
             url = "http://{0}/webhdfs/v1/?{1}op=CANCELDELEGATIONTOKEN&token={2}".format(self.endpoint, self.auth, self.delegationToken)
             self.put(url)
+        self.pool.close()
+
+    def httpGet(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def httpPut(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def httpPost(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def httpDelete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def request(self, method, url, retries=None, **kwargs):
+        """ Retried up to retries times (Default: self.retries). Return the last response, or raise the last error """
+        attempt = 0
+        while True:
+            try:
+                with self.pool.session(url) as session:
+                    resp = session.request(method, url, timeout=self.timeout, **kwargs)
+                if resp.status_code < 500 or not self.retry(attempt, url, "http code {0}".format(resp.status_code), retries):
+                    return resp
+            except RETRIABLE as e:
+                if not self.retry(attempt, url, e, retries):
+                    raise
+            attempt += 1
+
+    def retry(self, attempt, what, reason, retries=None):
+        """ If attempt (from 0) failed for reason is to be retried, wait for it and return True """
+        retries = self.retries if retries == None else retries
+        if attempt >= retries:
+            return False
+        delay = random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+        logger.warning("{0}: {1}. Retry {2}/{3} in {4:.1f}s".format(what, reason, attempt + 1, retries, delay))
+        time.sleep(delay)
+        return True
+
+    def getConnectionStats(self):
+        return self.pool.getStats()
             
 
     def getPathTypeAndStatus(self, path):
         url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILESTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
+        resp = self.httpGet(url)
         logger.debug(url + " -> " + str(resp.status_code)) 
         if resp.status_code == 200:
             result = resp.json()
             fs = {}
             fs['size'] = result['FileStatus']['length']
             fs['modificationTime'] = result['FileStatus']['modificationTime']/1000
+            fs['modificationTimeMs'] = result['FileStatus']['modificationTime']
             fs['mode'] = "0" + result['FileStatus']['permission']
             fs['owner'] = result['FileStatus']['owner']
             fs['group'] = result['FileStatus']['group']
+            fs['fileId'] = result['FileStatus'].get('fileId')
             return (result['FileStatus']['type'], fs)
         elif resp.status_code == 404:
             return ("NOT_FOUND", None)
@@ -106,9 +199,56 @@ class WebHDFS:
         else:
             misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
 
-    
+    def getContentSummary(self, path):
+        """ Return { 'fileCount': ..., 'directoryCount': ..., 'length': ..., ... } or None if not found or no access """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GETCONTENTSUMMARY".format(self.endpoint, path, self.auth)
+        resp = self.httpGet(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code == 200:
+            return resp.json()['ContentSummary']
+        elif resp.status_code == 404 or resp.status_code == 403:
+            return None
+        else:
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def getFileBlockLocations(self, path):
+        """ Return [ (<offset>, <length>, [ <datanode host>, ... ]), ... ], or None if not found or not supported by the cluster """
+        if not self.blockLocations:
+            return None
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILEBLOCKLOCATIONS".format(self.endpoint, path, self.auth)
+        resp = self.httpGet(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code == 200:
+            return [ (b['offset'], b['length'], b['hosts']) for b in resp.json()['BlockLocations']['BlockLocation'] ]
+        if resp.status_code == 404 or resp.status_code == 403:
+            return None
+        if resp.status_code != 400:
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+        # Before Hadoop 3.x, try the internal operation
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GET_BLOCK_LOCATIONS".format(self.endpoint, path, self.auth)
+        resp = self.httpGet(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code == 200:
+            return [ (b['startOffset'], b['block']['numBytes'], [ l['hostName'] for l in b['locations'] ]) for b in resp.json()['LocatedBlocks']['locatedBlocks'] ]
+        if resp.status_code == 404 or resp.status_code == 403:
+            return None
+        logger.warning("Block locations not available from {0} (http code {1}). Datanode aware scheduling disabled".format(self.endpoint, resp.status_code))
+        self.blockLocations = False
+        return None
+
+    def getFileChecksum(self, path):
+        """ Return the 'FileChecksum' object ({ 'algorithm': ..., 'bytes': <hex>, 'length': ... }), or None if not found """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=GETFILECHECKSUM".format(self.endpoint, path, self.auth)
+        resp = self.httpGet(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code == 200:
+            return resp.json()['FileChecksum']
+        if resp.status_code == 404 or resp.status_code == 403:
+            return None
+        misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
     def put(self, url):
-        resp = requests.put(url, allow_redirects=False)
+        resp = self.httpPut(url, allow_redirects=False)
         logger.debug(url + " -> " + str(resp.status_code)) 
         if resp.status_code != 200:  
             misc.ERROR("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
@@ -128,6 +268,16 @@ class WebHDFS:
         url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER&group={3}".format(self.endpoint, path, self.auth, group)
         self.put(url)
     
+    def setOwnerAndGroup(self, path, owner, group):
+        """ A single SETOWNER call. owner or group may be None """
+        params = ""
+        if owner != None:
+            params += "&owner=" + owner
+        if group != None:
+            params += "&group=" + group
+        url = "http://{0}/webhdfs/v1{1}?{2}op=SETOWNER{3}".format(self.endpoint, path, self.auth, params)
+        self.put(url)
+
     def setPermission(self, path, permission):
         url = "http://{0}/webhdfs/v1{1}?{2}op=SETPERMISSION&permission={3}".format(self.endpoint, path, self.auth, permission)
         self.put(url)
@@ -138,77 +288,381 @@ class WebHDFS:
         self.put(url)
            
     def rename(self, hdfsPath, newName):
+        """ Return False if not renamed (i.e. newName already existing) """
         url = "http://{0}/webhdfs/v1{1}?{2}op=RENAME&destination={3}".format(self.endpoint, hdfsPath, self.auth, newName)
-        self.put(url)
+        resp = self.httpPut(url, allow_redirects=False)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code != 200:  
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+        return resp.json()['boolean']
            
     def getDirContent(self, path):
-        url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS".format(self.endpoint, path, self.auth)
-        resp = requests.get(url)
-        logger.debug(url + " -> " + str(resp.status_code)) 
+        """
+        Return a dirContent: { 'status': 'OK|NOT_FOUND|NO_ACCESS', 'entries': <generator> }
+        
+        The generator yields a ('FILE'|'DIRECTORY', <entry>) tuple per directory entry, as they are parsed.
+        Directory is fetched by pages (LISTSTATUS_BATCH), if supported by the namenode.
+        """
         dirContent = {}
         dirContent['status'] = "OK"
-        dirContent['files'] = []
-        dirContent['directories'] = []
+        dirContent['entries'] = None
+        (url, resp) = self.getListingPage(path, None)
         if resp.status_code == 200:
-            result = resp.json()
-            #print misc.pprint2s(result)
-            for f in result['FileStatuses']['FileStatus']:
-                if f['type'] == 'FILE':
-                    fi = {}
-                    fi['name'] = f['pathSuffix']
-                    fi['size'] = f['length']
-                    fi['modificationTime'] = f['modificationTime']/1000
-                    fi['mode'] = "0" + f['permission']
-                    fi['owner'] = f['owner']
-                    fi['group'] = f['group']
-                    dirContent['files'].append(fi)
-                elif f['type'] == 'DIRECTORY':
-                    di = {}
-                    di['name'] = f['pathSuffix']
-                    #di['modificationTime'] = f['modificationTime']/1000
-                    di['mode'] = "0" + f['permission']
-                    di['owner'] = f['owner']
-                    di['group'] = f['group']
-                    dirContent['directories'].append(di)
-                else:
-                    misc.ERROR("Unknown directory entry type: {0}".format(f['type']))
-        elif resp.status_code == 404:
-            dirContent['status'] = "NOT_FOUND"
-        elif resp.status_code == 403:
-            dirContent['status'] = "NO_ACCESS"
+            dirContent['entries'] = self.iterDirContent(path, url, resp)
         else:
-            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+            self.releaseListing(resp, True)
+            if resp.status_code == 404:
+                dirContent['status'] = "NOT_FOUND"
+            elif resp.status_code == 403:
+                dirContent['status'] = "NO_ACCESS"
+            else:
+                misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
         return dirContent
-   
 
-    def putFileToHdfs(self, localPath, hdfsPath, overwrite):
+    def getListingPage(self, path, startAfter):
+        if self.batchListing:
+            url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS_BATCH".format(self.endpoint, path, self.auth)
+            if startAfter != None:
+                url = url + "&startAfter=" + urllib.quote(startAfter, safe='')
+            resp = self.listingRequest(url)
+            if resp.status_code != 400:
+                return (url, resp)
+            # Namenode older than Hadoop 2.8. Switch to the plain LISTSTATUS for the whole run
+            self.releaseListing(resp, True)
+            logger.info("LISTSTATUS_BATCH not supported by {0}. Will use LISTSTATUS".format(self.endpoint))
+            self.batchListing = False
+        url = "http://{0}/webhdfs/v1{1}?{2}op=LISTSTATUS".format(self.endpoint, path, self.auth)
+        return (url, self.listingRequest(url))
+    
+    def listingRequest(self, url):
+        # Streamed, so the session is kept borrowed up to the page is fully parsed
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            session = self.pool.acquire(host)
+            try:
+                resp = session.get(url, stream=True, timeout=self.timeout)
+            except RETRIABLE as e:
+                self.pool.release(host, session)
+                if not self.retry(attempt, url, e):
+                    raise
+                attempt += 1
+                continue
+            except:
+                self.pool.release(host, session)
+                raise
+            logger.debug(url + " -> " + str(resp.status_code)) 
+            resp.session = session
+            resp.host = host
+            if resp.status_code < 500 or attempt >= self.retries:
+                return resp
+            self.releaseListing(resp, True)
+            self.retry(attempt, url, "http code {0}".format(resp.status_code))
+            attempt += 1
+
+    def releaseListing(self, resp, fullyRead):
+        if fullyRead:
+            resp.content  # Consume socket so it can be released
+        else:
+            resp.close()
+        self.pool.release(resp.host, resp.session)
+    
+    def iterDirContent(self, path, url, resp):
+        batch = "LISTSTATUS_BATCH" in url
+        while True:
+            page = { 'remainingEntries': 0, 'last': None }
+            fullyRead = False
+            try:
+                for f in parseListingPage(resp, batch, page):
+                    # Names are handled as utf-8 str, as local ones. So both can be compared (and sorted)
+                    name = f['pathSuffix'].encode('utf-8')
+                    page['last'] = name
+                    if f['type'] == 'FILE':
+                        fi = {}
+                        fi['name'] = name
+                        fi['size'] = f['length']
+                        fi['modificationTime'] = f['modificationTime']/1000
+                        fi['mode'] = "0" + f['permission']
+                        fi['owner'] = f['owner']
+                        fi['group'] = f['group']
+                        yield ('FILE', fi)
+                    elif f['type'] == 'DIRECTORY':
+                        di = {}
+                        di['name'] = name
+                        di['modificationTimeMs'] = f['modificationTime']    # Full precision, for listing cache validation
+                        di['mode'] = "0" + f['permission']
+                        di['owner'] = f['owner']
+                        di['group'] = f['group']
+                        yield ('DIRECTORY', di)
+                    else:
+                        misc.ERROR("Unknown directory entry type: {0}".format(f['type']))
+                fullyRead = True
+            finally:
+                self.releaseListing(resp, fullyRead)
+            if not batch or page['remainingEntries'] == 0 or page['last'] == None:
+                return
+            (url, resp) = self.getListingPage(path, page['last'])
+            if resp.status_code != 200:
+                self.releaseListing(resp, True)
+                misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+
+    def putFileToHdfs(self, localPath, hdfsPath, overwrite, permission=None, digest=None):
+        """ If digest (a checksum.Digest) is provided, data sent is fed to it """
         logger.debug("putFileToHdfs(localPath={0}, hdfsPath={1})".format(localPath, hdfsPath))
+        self.uploadRange(localPath, hdfsPath, 0, os.path.getsize(localPath), overwrite, permission, None, digest)
+
+    def uploadRange(self, localPath, hdfsPath, offset, length, overwrite, permission, blockSize, digest):
+        """
+        Upload length bytes of localPath, from offset, as hdfsPath. If interrupted, continue from the length reached
+        by hdfsPath: APPEND the remaining bytes. Or CREATE it again if empty, not existing, or still the file it was
+        to replace (The CREATE may fail before the datanode replaces it).
+        """
+        done = None     # Bytes in hdfsPath, once created
+        replaced = None # Identity of the file to overwrite, if any
+        if overwrite and self.retries > 0:
+            (ft, status) = self.getPathTypeAndStatus(hdfsPath)
+            if ft == "FILE":
+                replaced = fileIdentity(status)
+        attempt = 0
+        while True:
+            try:
+                if done == None:
+                    with fastio.FileBody(localPath, self.chunkSize, offset, length, digest) as body:
+                        self.createFile(hdfsPath, body, overwrite, permission, blockSize)
+                elif done < length:
+                    with fastio.FileBody(localPath, self.chunkSize, offset + done, length - done, digest) as body:
+                        self.appendFile(hdfsPath, body)
+                return
+            except RETRIABLE as e:
+                if not self.retry(attempt, hdfsPath, e):
+                    raise
+            attempt += 1
+            (ft, status) = self.getPathTypeAndStatus(hdfsPath)
+            if ft == "FILE" and 0 < status['size'] <= length and fileIdentity(status) != replaced:
+                done = status['size']
+                logger.info("{0}: Continuing upload from offset {1}".format(hdfsPath, done))
+            elif ft == "NOT_FOUND" or ft == "FILE":
+                # Nothing written by this upload to keep
+                (done, overwrite) = (None, True)
+            else:
+                misc.ERROR("Unable to continue upload of '{0}': Unexpected type '{1}' or size", hdfsPath, ft)
+            if digest != None:
+                digest.resumeAt(done or 0)
+
+    def createFile(self, hdfsPath, data, overwrite, permission=None, blockSize=None):
         url = "http://{0}/webhdfs/v1{1}?{2}op=CREATE&overwrite={3}".format(self.endpoint, hdfsPath, self.auth, "true" if overwrite else "false")
-        resp = requests.put(url, allow_redirects=False)
+        if permission != None:
+            url += "&permission={0}".format(permission)
+        if blockSize != None:
+            url += "&blocksize={0}".format(blockSize)
+        resp = self.httpPut(url, allow_redirects=False)
         logger.debug(url + " -> " + str(resp.status_code)) 
         if not resp.status_code == 307:
             misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
         url2 = resp.headers['location']    
         logger.debug(url2)
-        f = open(localPath, "rb")
-        resp2 = requests.put(url2, data=f, headers={'content-type': 'application/octet-stream'})
+        # data can't be sent again. An interruption is handled by the caller
+        resp2 = self.httpPut(url2, data=data, headers={'content-type': 'application/octet-stream'}, retries=0)
         logger.debug(url2 + " -> " + str(resp2.status_code)) 
+        if resp2.status_code >= 500:
+            resp2.raise_for_status()
         if not resp2.status_code == 201:
             misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp2.status_code, url2))
-           
-    def getFileFromHdfs(self, hdfsPath, localPath, overwrite):
-        logger.debug("getFileFromHdfs(localPath={0}, hdfsPath={1})".format(localPath, hdfsPath))
-        if os.path.exists(localPath) and not overwrite:
-            misc.ERROR("Local file {0} already exists. Will not overwrite it!".format(localPath))
-        f = open(localPath, "wb")
-        url = "http://{0}/webhdfs/v1{1}?{2}op=OPEN".format(self.endpoint, hdfsPath, self.auth)
-        resp = requests.get(url, allow_redirects=True, stream=True)
+
+    def appendFile(self, hdfsPath, data):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=APPEND".format(self.endpoint, hdfsPath, self.auth)
+        resp = self.httpPost(url, allow_redirects=False)
         logger.debug(url + " -> " + str(resp.status_code)) 
-        if not resp.status_code == 200:
+        if not resp.status_code == 307:
             misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
-        for chunk in resp.iter_content(chunk_size=10240, decode_unicode=False):
-            f.write(chunk)
-        f.close()
+        url2 = resp.headers['location']
+        resp2 = self.httpPost(url2, data=data, headers={'content-type': 'application/octet-stream'}, retries=0)
+        logger.debug(url2 + " -> " + str(resp2.status_code)) 
+        if resp2.status_code >= 500 or resp2.status_code == 403:
+            # 403: The lease of the interrupted writer may be not recovered yet
+            resp2.raise_for_status()
+        if not resp2.status_code == 200:
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp2.status_code, url2))
+
+    def putFileToHdfsByParts(self, localPath, hdfsPath, overwrite, permission, size, partSize, blockSize, nbrThreads, limiter=None, verification=None):
+        """
+        Upload parts of partSize bytes (A multiple of blockSize) in parallel, as temporary files in the target directory.
+        Then CONCAT them in the first one, which is renamed to hdfsPath. Parts are removed on failure.
+        If limiter (a concurrency.Limiter) is provided, parts are uploaded under it. So it may be shared by all files.
+        If verification (a checksum.Verification) is provided, data sent is fed to the digest of each part.
+        """
+        logger.debug("putFileToHdfsByParts(localPath={0}, hdfsPath={1}, partSize={2})".format(localPath, hdfsPath, partSize))
+        (folder, name) = os.path.split(hdfsPath)
+        parts = []
+        for offset in range(0, size, partSize):
+            parts.append((os.path.join(folder, ".{0}.part{1}~".format(name, len(parts))), offset, min(partSize, size - offset)))
+        try:
+            pool = WorkerPool(min(nbrThreads, len(parts)), "parts", limiter)
+            for (partPath, offset, length) in parts:
+                pool.submit(self.putPartToHdfs, localPath, partPath, offset, length, permission, blockSize, verification.digest(offset) if verification != None else None)
+            pool.join()
+            self.concat(parts[0][0], [ part[0] for part in parts[1:] ])
+            if overwrite:
+                self.delete(hdfsPath)
+            if not self.rename(parts[0][0], hdfsPath):
+                misc.ERROR("Unable to rename '{0}' to '{1}'", parts[0][0], hdfsPath)
+        except (Exception, SystemExit):
+            for part in parts:
+                try:
+                    self.delete(part[0])
+                except (Exception, SystemExit):
+                    pass
+            raise
+
+    def putPartToHdfs(self, localPath, partPath, offset, length, permission, blockSize, digest=None):
+        self.uploadRange(localPath, partPath, offset, length, True, permission, blockSize, digest)
+
+    def concat(self, hdfsPath, sources):
+        url = "http://{0}/webhdfs/v1{1}?{2}op=CONCAT&sources={3}".format(self.endpoint, hdfsPath, self.auth, ",".join(urllib.quote(s) for s in sources))
+        resp = self.httpPost(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code != 200:  
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+
+    def delete(self, hdfsPath):
+        """ Return False if hdfsPath was not existing """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=DELETE&recursive=false".format(self.endpoint, hdfsPath, self.auth)
+        resp = self.httpDelete(url)
+        logger.debug(url + " -> " + str(resp.status_code)) 
+        if resp.status_code != 200:  
+            misc.ERROR("Invalid returned http code '{0}' when calling '{1}'", resp.status_code, url)
+        return resp.json()['boolean']
+           
+    def getFileFromHdfs(self, hdfsPath, localFile, datanode=None, digest=None):
+        """
+        localFile is a fastio.LocalFile. If datanode is provided, read from it instead of the one choosen by the namenode
+        If digest (a checksum.Digest) is provided, data received is fed to it.
+        """
+        logger.debug("getFileFromHdfs(localPath={0}, hdfsPath={1})".format(localFile.path, hdfsPath))
+        size = self.readFromHdfs(hdfsPath, localFile, None, localFile.size, datanode, digest)
+        if size < localFile.size:
+            misc.ERROR("Got {0} bytes instead of {1} from '{2}'", size, localFile.size, hdfsPath)
+
+    def getRangeFromHdfs(self, hdfsPath, localFile, offset, length, datanode=None, digest=None):
+        """ Copy a range of hdfsPath at the same offset in localFile """
+        logger.debug("getRangeFromHdfs(localPath={0}, hdfsPath={1}, offset={2}, length={3})".format(localFile.path, hdfsPath, offset, length))
+        size = self.readFromHdfs(hdfsPath, localFile, offset, length, datanode, digest)
+        if size != length:
+            misc.ERROR("Got {0} bytes instead of {1} at offset {2} of '{3}'", size, length, offset, hdfsPath)
+
+    def readFromHdfs(self, hdfsPath, localFile, offset, length, datanode, digest=None):
+        """
+        Copy length bytes of hdfsPath from offset (The whole file if None) at the same offset in localFile. Return the
+        number of bytes written. If interrupted, or if less than length bytes are received, resume from the last byte
+        written. Then from the datanode choosen by the namenode, as datanode may be the failing one.
+        """
+        copied = 0
+        attempt = 0
+        while True:
+            stream = CountingStream()
+            start = offset if copied == 0 else (offset or 0) + copied
+            remaining = length - copied if length != None else None
+            try:
+                self.readOnce(hdfsPath, localFile, start, remaining, datanode if attempt == 0 else None, digest, stream)
+            except RETRIABLE as e:
+                copied += stream.count
+                if not self.retry(attempt, hdfsPath, e):
+                    raise
+                attempt += 1
+                continue
+            copied += stream.count
+            if length == None or copied >= length or not self.retry(attempt, hdfsPath, "Got {0} bytes instead of {1}".format(copied, length)):
+                return copied
+            attempt += 1
+
+    def readOnce(self, hdfsPath, localFile, offset, length, datanode, digest, stream):
+        """ Copy through stream (a CountingStream), so the number of bytes written is known even on failure """
+        url = "http://{0}/webhdfs/v1{1}?{2}op=OPEN".format(self.endpoint, hdfsPath, self.auth)
+        if offset != None:
+            url += "&offset={0}".format(offset)
+            if length != None:
+                url += "&length={0}".format(length)
+        # Redirection is handled here, to get the datanode connection from the pool
+        with self.pool.session(url) as session:
+            resp = session.get(url, allow_redirects=False, stream=True, timeout=self.timeout)
+            logger.debug(url + " -> " + str(resp.status_code)) 
+            if resp.status_code == 200:
+                # No redirection (i.e. HttpFS gateway)
+                stream.raw = resp.raw
+                return localFile.copyFrom(stream, offset or 0, self.chunkSize, digest)
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            if not resp.status_code == 307:
+                misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp.status_code, url))
+            url2 = resp.headers['location']
+            resp.content  # Consume socket so it can be released
+        if datanode != None:
+            url2 = redirectTo(url2, datanode)
+        with self.pool.session(url2) as session:
+            resp2 = session.get(url2, stream=True, timeout=self.timeout)
+            logger.debug(url2 + " -> " + str(resp2.status_code)) 
+            if resp2.status_code >= 500:
+                resp2.raise_for_status()
+            if not resp2.status_code == 200:
+                misc.ERROR("Invalid returned http code '{0}' when calling '{1}'".format(resp2.status_code, url2))
+            stream.raw = resp2.raw
+            return localFile.copyFrom(stream, offset or 0, self.chunkSize, digest)
+
+
+def fileIdentity(status):
+    """ fileId (Hadoop 2.x), or modification time and size if not provided """
+    return status['fileId'] if status.get('fileId') != None else (status['modificationTimeMs'], status['size'])
+
+
+class CountingStream:
+    """ Count the bytes read (readinto()) from raw """
+    def __init__(self):
+        self.raw = None
+        self.count = 0
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        self.count += n
+        return n
+
+
+def redirectTo(url, host):
+    """ Replace the host of url, keeping its port """
+    u = urlparse(url)
+    netloc = host if u.port == None else "{0}:{1}".format(host, u.port)
+    return u._replace(netloc=netloc).geturl()
+
+
+def parseListingPage(resp, batch, page):
+    """ Yield FileStatus of a LISTSTATUS or LISTSTATUS_BATCH response. Set page['remainingEntries'] for the later. """
+    if batch:
+        itemPrefix = "DirectoryListing.partialListing.FileStatuses.FileStatus.item"
+    else:
+        itemPrefix = "FileStatuses.FileStatus.item"
+    if HAS_IJSON:
+        # Incremental parsing. Only one entry at a time is in memory
+        resp.raw.decode_content = True
+        builder = None
+        for (prefix, event, value) in ijson.parse(resp.raw):
+            if builder != None:
+                builder.event(event, value)
+                if event == 'end_map' and prefix == itemPrefix:
+                    yield builder.value
+                    builder = None
+            elif event == 'start_map' and prefix == itemPrefix:
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == "DirectoryListing.remainingEntries":
+                page['remainingEntries'] = value
+    else:
+        result = resp.json()
+        if batch:
+            page['remainingEntries'] = result['DirectoryListing']['remainingEntries']
+            statuses = result['DirectoryListing']['partialListing']['FileStatuses']['FileStatus']
+        else:
+            statuses = result['FileStatuses']['FileStatus']
+        for f in statuses:
+            yield f
 
                 
 def lookup(p):   
@@ -230,7 +684,7 @@ def lookup(p):
                 misc.ERROR("Unable to find {0}* or {1}* in {2}. Provide explicit 'webhdfs_endpoint'", NN_HTTP_TOKEN1, NN_HTTP_TOKEN2, hspath)
             errors = []
             for endpoint in candidates:
-                webHDFS= WebHDFS(endpoint, p.hdfsUser)
+                webHDFS= WebHDFS(endpoint, p.hdfsUser, max(2 * p.nbrThreads, p.nbrListingThreads), p.chunkSize, p.retries, p.timeout)  # Data and metadata threads
                 (x, err) = webHDFS.test()
                 if x:
                     p.webhdfsEndpoint = webHDFS.endpoint
@@ -244,7 +698,7 @@ def lookup(p):
         candidates = p.webhdfsEndpoint.split(",")
         errors = []
         for endpoint in candidates:
-            webHDFS= WebHDFS(endpoint, p.hdfsUser)
+            webHDFS= WebHDFS(endpoint, p.hdfsUser, max(2 * p.nbrThreads, p.nbrListingThreads), p.chunkSize, p.retries, p.timeout)  # Data and metadata threads
             (x, err) = webHDFS.test()
             if x:
                 p.webhdfsEndpoint = webHDFS.endpoint
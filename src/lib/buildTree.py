@@ -13,7 +13,24 @@
 #limitations under the License.
 #
 import os
+import stat
 import misc
+import threading
+import time
+import logging
+from common import WorkerPool
+from entryMap import EntryMap, FILE_FIELDS, DIRECTORY_FIELDS
+from listingCache import entryToTuple, tupleToEntry
+
+logger = logging.getLogger("hdfsmirror.buildTree")
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 """
 This functions set walk in directories and return a Dict() like:
@@ -76,62 +93,117 @@ This for the following layout
 
 Works same way for local (Linux) FS and HDFS
 
+'directories' and 'files' are in fact EntryMap objects (see entryMap.py), a compact storage behaving as the dicts above.
+
 """
 
 
-def buildLocalTree(rroot):
+def buildLocalTree(rroot, nbrThreads=1, checksumCache=None):
+    """ checksumCache: If provided, files seen are recorded in it, and checksums of others evicted """
     tree = {}
     if rroot == "/":
         tree['slashTerminated'] = False
-        prefLen = len(rroot) 
     else:
         if rroot.endswith("/"):
             rroot = rroot[:-1]
             tree['slashTerminated'] = True
         else :
             tree['slashTerminated'] = False
-        prefLen = len(rroot) + 1
     tree['rroot'] = rroot
-    fileMap = {}
-    dirMap = {}
-    for root, dirs, files in os.walk(rroot, topdown=True, onerror=None, followlinks=False):
-        for fileName in files:
-            key = os.path.join(root, fileName)[prefLen:]
-            path = os.path.join(rroot, key)
-            stat = os.stat(path)
-            f = {}
-            f['size'] = stat.st_size
-            f['modificationTime'] = int(stat.st_mtime)
-            f['mode'] = "0" + oct(stat.st_mode)[-3:]
-            f['owner'] = misc.getUserNameFromId(stat.st_uid)
-            f['group'] = misc.getGroupNameGroupId(stat.st_gid)
-            fileMap[key] = f
-        for dirName in dirs:
-            key = os.path.join(root, dirName)[prefLen:]
-            path = os.path.join(rroot, key)
-            stat = os.stat(path)
-            f = {}
-            f['mode'] = "0" + oct(stat.st_mode)[-3:]
-            f['owner'] = misc.getUserNameFromId(stat.st_uid)
-            f['group'] = misc.getGroupNameGroupId(stat.st_gid)
-            dirMap[key] = f
+    fileMap = EntryMap(FILE_FIELDS)
+    dirMap = EntryMap(DIRECTORY_FIELDS)
+    startTime = time.time()
+    pool = WorkerPool(nbrThreads, "localWalker")
+    lock = threading.Lock()
+    pool.submit(walkInLocal, pool, lock, rroot, "", dirMap, fileMap, checksumCache)
+    pool.join()
+    fileMap.freeze()
+    dirMap.freeze()
+    duration = time.time() - startTime
+    nbrEntries = len(fileMap) + len(dirMap)
+    logger.info("{0}: {1} entries walked in {2:.1f}s ({3:.0f} entries/s)".format(rroot, nbrEntries, duration, nbrEntries / max(duration, 0.001)))
+    if checksumCache != None:
+        logger.info("{0}: {1} checksums of removed files evicted from checksum cache".format(rroot, checksumCache.evict()))
     tree['files'] = fileMap
     tree['directories'] = dirMap
     return tree
 
+def walkInLocal(pool, lock, current, prefix, dirMap, fileMap, checksumCache):
+    try:
+        entries = listLocalDir(current)
+    except OSError as e:
+        logger.warning("{0}: Unable to list directory ({1}). Skipped".format(current, e))
+        return
+    files = []
+    dirs = []
+    subDirs = []
+    stats = []
+    for (name, st, isDir, isLink) in entries:
+        key = prefix + name
+        if isDir:
+            dirs.append((key, statToEntry(st, False)))
+            if not isLink:
+                subDirs.append((os.path.join(current, name), key + "/"))
+        else:
+            files.append((key, statToEntry(st, True)))
+            stats.append(st)
+    with lock:
+        for (key, f) in files:
+            fileMap[key] = f
+        for (key, d) in dirs:
+            dirMap[key] = d
+        fileMap.freeze(prefix)
+        dirMap.freeze(prefix)
+    if checksumCache != None:
+        checksumCache.see(stats)
+    for (path, subPrefix) in subDirs:
+        pool.submit(walkInLocal, pool, lock, path, subPrefix, dirMap, fileMap, checksumCache)
+            
+def listLocalDir(path):
+    """ 
+    Return a list of (name, stat, isDir, isLink). stat and isDir follow symlinks, as os.walk() 
+    With scandir, a single stat() system call is issued per entry.
+    Entries which can't be stat'ed (Broken symlink, entry removed during the walk, ...) are skipped.
+    Raise OSError only if the directory itself can't be listed.
+    """
+    result = []
+    if scandir != None:
+        for entry in scandir(path):
+            try:
+                st = entry.stat()
+                result.append((entry.name, st, stat.S_ISDIR(st.st_mode), entry.is_symlink()))
+            except OSError as e:
+                logger.warning("{0}: Unable to stat ({1}). Skipped".format(os.path.join(path, entry.name), e))
+    else:
+        for name in os.listdir(path):
+            p = os.path.join(path, name)
+            try:
+                st = os.lstat(p)
+                isLink = stat.S_ISLNK(st.st_mode)
+                if isLink:
+                    st = os.stat(p)
+            except OSError as e:
+                logger.warning("{0}: Unable to stat ({1}). Skipped".format(p, e))
+                continue
+            result.append((name, st, stat.S_ISDIR(st.st_mode), isLink))
+    return result
 
-def getLocalPathStatus(path):
-    stat = os.stat(path)
+def statToEntry(st, isFile):
     f = {}
-    f['size'] = stat.st_size
-    f['modificationTime'] = int(stat.st_mtime)
-    f['mode'] = "0" + oct(stat.st_mode)[-3:]
-    f['owner'] = misc.getUserNameFromId(stat.st_uid)
-    f['group'] = misc.getGroupNameGroupId(stat.st_gid)
+    if isFile:
+        f['size'] = int(st.st_size)
+        f['modificationTime'] = int(st.st_mtime)
+    f['mode'] = "0" + oct(int(st.st_mode))[-3:]
+    # Names are cached by misc. So resolved once per distinct uid/gid
+    f['owner'] = misc.getUserNameFromId(int(st.st_uid))
+    f['group'] = misc.getGroupNameGroupId(int(st.st_gid))
     return f
+
+def getLocalPathStatus(path):
+    return statToEntry(os.stat(path), True)
     
     
-def buildHdfsTree(webHdfs, rroot):
+def buildHdfsTree(webHdfs, rroot, nbrThreads=1, cache=None, pruner=None):
     tree = {}
     if rroot == "/":
         tree['slashTerminated'] = False
@@ -144,38 +216,106 @@ def buildHdfsTree(webHdfs, rroot):
             tree['slashTerminated'] = False
         prefLen = len(rroot) + 1
     tree['rroot'] = rroot
-    fileMap = {}
-    dirMap = {}
-    noAccess = []
-    walkInHdfs(webHdfs, rroot, dirMap, fileMap, noAccess, prefLen)
-    tree['files'] = fileMap
-    tree['directories'] = dirMap
-    tree['noAccess'] = noAccess
+    walker = HdfsWalker(webHdfs, nbrThreads, prefLen, cache, pruner)
+    walker.run(rroot)
+    if cache != None:
+        cache.commit()
+        logger.info("{0}: {1} directories served from listing cache, {2} listed".format(rroot, cache.hits, cache.misses))
+    if pruner != None:
+        logger.info("{0}: {1} subtrees pruned ({2} directories not listed), {3} GETCONTENTSUMMARY calls. {4} namenode calls saved".format(rroot, len(pruner.pruned), pruner.savedListings, pruner.summaryCalls, pruner.savedListings - pruner.summaryCalls))
+        tree['pruned'] = pruner.pruned
+    tree['files'] = walker.fileMap
+    tree['directories'] = walker.dirMap
+    tree['noAccess'] = walker.noAccess
     return tree
 
-def walkInHdfs(webHdfs, current, dirMap, fileMap, noAccess, prefLen):
-    dirContent = webHdfs.getDirContent(current)
-    #print misc.pprint2s(dirContent)
-    if dirContent['status'] == "OK":
-        for f in dirContent['files']:
-            path = os.path.join(current, f['name'])[prefLen:]
-            del f['name']
-            fileMap[path] = f
-        for d in dirContent['directories']:
-            #print misc.pprint2s(d)
-            path = os.path.join(current, d['name'])
-            del d['name']
-            dirMap[path[prefLen:]] = d
-            walkInHdfs(webHdfs, path, dirMap, fileMap, noAccess, prefLen)
-    elif dirContent['status'] == "NO_ACCESS":
-        noAccess.append(current)
-    else:
-        raise Exception("Invalid DirContent status: {0} for path:'{1}'".format(dirContent.status, current)) 
+
+class HdfsWalker:
+    """
+    Breadth first walk: Each listed directory submit its sub-directories to the pool, so siblings are listed in parallel.
+    """
+    def __init__(self, webHdfs, nbrThreads, prefLen, cache, pruner):
+        self.webHdfs = webHdfs
+        self.prefLen = prefLen
+        self.cache = cache
+        self.pruner = pruner
+        self.fileMap = EntryMap(FILE_FIELDS)
+        self.dirMap = EntryMap(DIRECTORY_FIELDS)
+        self.noAccess = []
+        self.lock = threading.Lock()
+        self.pool = WorkerPool(nbrThreads, "hdfsWalker")
+        
+    def run(self, rroot):
+        self.pool.submit(self.walk, rroot, None)
+        self.pool.join()
+        self.fileMap.freeze()
+        self.dirMap.freeze()
+
+    def walk(self, current, mtimeMs):
+        """ mtimeMs: Modification time of current, if known to be up to date. Only used with a listing cache. """
+        if self.pruner != None and self.pruner.prune(current, current[self.prefLen:]):
+            if self.cache != None:
+                self.cache.retain(current)
+            return
+        entries = None
+        if self.cache != None:
+            if mtimeMs == None:
+                (ft, status) = self.webHdfs.getPathTypeAndStatus(current)
+                if ft == "NO_ACCESS":
+                    with self.lock:
+                        self.noAccess.append(current)
+                    return
+                elif ft != "DIRECTORY":
+                    raise Exception("Invalid type: {0} for path:'{1}'".format(ft, current)) 
+                mtimeMs = status['modificationTimeMs']
+            cached = self.cache.get(current, mtimeMs)
+            if cached != None:
+                # Modification times of sub-directories may be stale. So, they will be checked.
+                entries = [ tupleToEntry(t) for t in cached ]
+                for (entryType, entry) in entries:
+                    if entryType == 'DIRECTORY':
+                        entry['modificationTimeMs'] = None
+        if entries == None:
+            dirContent = self.webHdfs.getDirContent(current)
+            if dirContent['status'] == "NO_ACCESS":
+                with self.lock:
+                    self.noAccess.append(current)
+                return
+            elif dirContent['status'] != "OK":
+                raise Exception("Invalid DirContent status: {0} for path:'{1}'".format(dirContent['status'], current)) 
+            entries = dirContent['entries']
+            if self.cache != None:
+                entries = self.caching(current, mtimeMs, entries)
+        subDirs = []
+        # Entries are consumed as they are received. The whole directory is never held in memory (Unless cached).
+        for (entryType, entry) in entries:
+            path = os.path.join(current, entry['name'])
+            if entryType == 'FILE':
+                with self.lock:
+                    self.fileMap[path[self.prefLen:]] = entry
+            else:
+                with self.lock:
+                    self.dirMap[path[self.prefLen:]] = entry
+                subDirs.append((path, entry.get('modificationTimeMs')))
+        with self.lock:
+            prefix = os.path.join(current, "")[self.prefLen:]
+            self.fileMap.freeze(prefix)
+            self.dirMap.freeze(prefix)
+        for (path, subMtimeMs) in subDirs:
+            self.pool.submit(self.walk, path, subMtimeMs)
+
+    def caching(self, current, mtimeMs, entries):
+        """ Pass entries through, and store them in the cache once all consumed """
+        tuples = []
+        for (entryType, entry) in entries:
+            tuples.append(entryToTuple(entryType, entry))
+            yield (entryType, entry)
+        self.cache.put(current, mtimeMs, tuples)
 
 def buildEmptyTree(rroot):
         tree = {}
-        tree['files'] = {}
-        tree['directories'] = {}
+        tree['files'] = EntryMap(FILE_FIELDS)
+        tree['directories'] = EntryMap(DIRECTORY_FIELDS)
         tree['noAccess'] = []
         if rroot == "/":
             tree['slashTerminated'] = False
@@ -0,0 +1,369 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import re
+import sys
+import time
+import zlib
+import struct
+import hashlib
+import binascii
+import logging
+import threading
+import multiprocessing
+from array import array
+from common import WorkerPool
+import planner
+import fastio
+
+logger = logging.getLogger("hdfsmirror.checksum")
+
+HAS_CRC32C = False
+try:
+    import crc32c
+    HAS_CRC32C = True
+except ImportError:
+    pass
+
+"""
+Content comparison (--compare checksum), compatible with HDFS file checksums.
+
+HDFS file checksum (GETFILECHECKSUM) is a MD5-of-MD5-of-CRC32(C): A CRC32 or CRC32C (Hadoop 2 default) of each
+'bytesPerCrc' bytes chunk. Then a MD5 of the CRCs (4 bytes, big endian) of each block. Then a MD5 of the MD5 of all
+blocks. 'crcPerBlock' is the number of CRCs of a full block, or 0 if the file has a single block.
+The same is computed on the local file, with the bytesPerCrc, crcPerBlock and CRC type of the HDFS checksum. So the
+block size of the HDFS file is not needed.
+
+Files of same size on both sides are compared (whatever their modification time). Remote checksums are fetched by
+nbrThreads threads, while local ones are computed by a pool of processes (CRCs are CPU bound), reading by BUFFER_SIZE
+blocks.
+
+Inline verification (--verify): Digests are computed on the data as it is transferred (Digest), and checked against
+the HDFS checksum once the file is copied. So the data is not read twice. On mismatch, the file is queued again, up to
+MAX_ATTEMPTS times.
+
+With crc32c package, CRC32C is computed natively. Otherwise a (slow) python implementation is used.
+Other algorithms (i.e. COMPOSITE-CRC, with dfs.checksum.combine.mode) can't be compared. Size and modification time
+are then compared, as usual.
+"""
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# HDFS defaults (dfs.bytes-per-checksum, dfs.checksum.type), for uploads digests
+DEFAULT_BYTES_PER_CRC = 512
+DEFAULT_CRC_TYPE = "CRC32C"
+
+MAX_ATTEMPTS = 3
+
+ALGORITHM = re.compile(r"^MD5-of-\d+MD5-of-\d+(CRC32C?)$")
+
+
+def makeCrc32cTable():
+    table = []
+    for i in range(0, 256):
+        crc = i
+        for _ in range(0, 8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC32C_TABLE = makeCrc32cTable()
+
+def pythonCrc32c(data):
+    crc = 0xffffffff
+    for b in bytearray(data):
+        crc = CRC32C_TABLE[(crc ^ b) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+def crcFunction(crcType):
+    """ Return a function computing the crc (as unsigned int) of a buffer """
+    if crcType == "CRC32":
+        return lambda data: zlib.crc32(data) & 0xffffffff
+    if HAS_CRC32C:
+        # Named crc32() before crc32c 2.0
+        return getattr(crc32c, "crc32c", None) or crc32c.crc32
+    return pythonCrc32c
+
+
+def parseChecksum(fileChecksum):
+    """ fileChecksum: As returned by WebHDFS.getFileChecksum(). Return (bytesPerCrc, crcPerBlock, crcType, md5), or None if algorithm is not supported """
+    m = ALGORITHM.match(fileChecksum['algorithm'])
+    if m == None:
+        return None
+    data = binascii.unhexlify(fileChecksum['bytes'])
+    (bytesPerCrc, crcPerBlock) = struct.unpack(">iq", data[:12])
+    return (bytesPerCrc, crcPerBlock, m.group(1), binascii.hexlify(data[12:28]))
+
+
+def localChecksum(path, bytesPerCrc, crcPerBlock, crcType):
+    """ Return the md5 (as hex string) of the MD5-of-MD5-of-CRC checksum of a local file """
+    digest = Digest(bytesPerCrc, crcPerBlock * bytesPerCrc if crcPerBlock > 0 else None, crcType)
+    buf = bytearray((BUFFER_SIZE // bytesPerCrc) * bytesPerCrc)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if n == 0:
+                break
+            digest.update(buf, n)
+    return combine(digest.blockMd5s())
+
+def blockMd5(crcs):
+    if sys.byteorder == "little":
+        crcs.byteswap()
+    return hashlib.md5(crcs.tostring()).digest()
+
+def combine(blockMd5s):
+    """ Return the file md5 (as hex string) from the md5 of its blocks """
+    return hashlib.md5("".join(blockMd5s)).hexdigest()
+
+
+class Digest:
+    """
+    Incremental MD5-of-MD5-of-CRC of a file, or of a range of a file starting on a block boundary.
+    update() can be called with any length. blockSize is None for a single block file.
+    """
+    def __init__(self, bytesPerCrc, blockSize, crcType):
+        self.bytesPerCrc = bytesPerCrc
+        self.blockSize = blockSize
+        self.crc = crcFunction(crcType)
+        self.crcs = array('I')
+        self.inBlock = 0
+        self.blocks = []
+        self.partial = bytearray()  # Start of a chunk, when data was not ending on a chunk boundary
+        self.length = 0
+        self.broken = False         # Data was not digested in sequence. Useless
+
+    def resumeAt(self, length):
+        """ Data is sent again from length (an interrupted upload). Only fine if exactly what was digested """
+        if length != self.length:
+            self.broken = True
+
+    def update(self, data, n):
+        """ Digest the n first bytes of data (a bytearray) """
+        if self.broken:
+            return
+        self.length += n
+        offset = 0
+        if len(self.partial) > 0:
+            offset = min(self.bytesPerCrc - len(self.partial), n)
+            self.partial += buffer(data, 0, offset)
+            if len(self.partial) < self.bytesPerCrc:
+                return
+            self.add(self.crc(buffer(self.partial)), self.bytesPerCrc)
+            self.partial = bytearray()
+        bytesPerCrc = self.bytesPerCrc
+        while n - offset >= bytesPerCrc:
+            self.add(self.crc(buffer(data, offset, bytesPerCrc)), bytesPerCrc)
+            offset += bytesPerCrc
+        if offset < n:
+            self.partial = bytearray(buffer(data, offset, n - offset))
+
+    def add(self, crc, length):
+        self.crcs.append(crc)
+        self.inBlock += length
+        if self.inBlock == self.blockSize:
+            self.blocks.append(blockMd5(self.crcs))
+            self.crcs = array('I')
+            self.inBlock = 0
+
+    def blockMd5s(self):
+        """ At end of data: Return the md5 of each block """
+        if len(self.partial) > 0:
+            self.add(self.crc(buffer(self.partial)), len(self.partial))
+            self.partial = bytearray()
+        if self.inBlock > 0:
+            self.blocks.append(blockMd5(self.crcs))
+            self.crcs = array('I')
+            self.inBlock = 0
+        return self.blocks
+
+
+class Verification:
+    """
+    --verify of a file transfer: Digests of the data as transferred, by ranges of rangeSize bytes (One if not split).
+    Digests are computed with bytesPerCrc, blockSize and crcType. Ranges digests can be combined only if ranges start
+    on block boundaries. Otherwise, or if parameters differ from the HDFS checksum ones, the local file is read again.
+    """
+    def __init__(self, bytesPerCrc, blockSize, crcType, size, rangeSize):
+        self.bytesPerCrc = bytesPerCrc
+        self.blockSize = blockSize
+        self.crcType = crcType
+        self.rangeSize = rangeSize
+        if size <= rangeSize or (blockSize != None and rangeSize % blockSize == 0):
+            self.digests = [ Digest(bytesPerCrc, blockSize, crcType) for _ in range(0, max(size, 1), rangeSize) ]
+        else:
+            self.digests = None
+
+    def digest(self, offset):
+        """ Digest of the range at offset, or None if not digested """
+        return self.digests[offset // self.rangeSize] if self.digests != None else None
+
+    def matches(self, localPath, remote):
+        """ Once all ranges transferred. remote: The HDFS checksum, from parseChecksum() """
+        (bytesPerCrc, crcPerBlock, crcType, md5) = remote
+        if self.digests != None and not any(digest.broken for digest in self.digests) and bytesPerCrc == self.bytesPerCrc and crcType == self.crcType:
+            blocks = [ block for digest in self.digests for block in digest.blockMd5s() ]
+            blockSize = crcPerBlock * bytesPerCrc if crcPerBlock > 0 else None
+            if blockSize == self.blockSize or (blockSize == None and len(blocks) == 1):
+                return combine(blocks) == md5
+        logger.debug("{0}: Checksum parameters differ from the transfer ones, or transfer was resumed. Reading it again".format(localPath))
+        return fastio.offload(localChecksum, localPath, bytesPerCrc, crcPerBlock, crcType) == md5
+
+
+class Verifier:
+    """ --verify state, shared by the copy threads (of a process) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}  # file -> Number of failed verifications
+        self.unsupported = set()
+
+    def remoteChecksum(self, webHDFS, hdfsPath):
+        """ Return the HDFS checksum of hdfsPath, from parseChecksum(). None if it can't be verified """
+        fileChecksum = webHDFS.getFileChecksum(hdfsPath)
+        if fileChecksum == None:
+            return None
+        parsed = parseChecksum(fileChecksum)
+        if parsed == None:
+            with self.lock:
+                if fileChecksum['algorithm'] not in self.unsupported:
+                    self.unsupported.add(fileChecksum['algorithm'])
+                    logger.warning("Checksum algorithm '{0}' can't be verified. Files with it are not verified".format(fileChecksum['algorithm']))
+        return parsed
+
+    def verify(self, f, localPath, verification, remote):
+        """ Return True if the transferred data of f matches remote, the HDFS checksum """
+        if verification.matches(localPath, remote):
+            return True
+        logger.warning("{0}: Checksum mismatch after copy".format(f))
+        return False
+
+    def isRetry(self, f):
+        with self.lock:
+            return f in self.failures
+
+    def failed(self, f):
+        """ Record a failed verification of f. Return True if it is to be copied again """
+        with self.lock:
+            self.failures[f] = self.failures.get(f, 0) + 1
+            return self.failures[f] < MAX_ATTEMPTS
+
+
+def printMismatches(threads, rroot):
+    """ threads have a 'mismatched' list of (<file>, <copied again>). Return the number of files given up """
+    mismatched = [ m for t in threads for m in t.mismatched ]
+    if len(mismatched) == 0:
+        return 0
+    print("{0} checksum mismatches after copy:".format(len(mismatched)))
+    for (f, again) in mismatched:
+        print("\t{0} ({1})".format(os.path.join(rroot, f), "copied again" if again else "given up"))
+    return len([ m for m in mismatched if not m[1] ])
+
+
+class Comparator:
+    """ Compare files content. localRoot and hdfsRoot: Roots of the local and HDFS trees. cache: A ChecksumCache, or None """
+    def __init__(self, webHDFS, localRoot, hdfsRoot, cache, p):
+        self.webHDFS = webHDFS
+        self.cache = cache
+        self.localRoot = localRoot
+        self.hdfsRoot = hdfsRoot
+        if p.engine == "gevent":
+            self.hashPool = None
+        else:
+            # Created first, so forked before our threads
+            self.hashPool = multiprocessing.Pool(min(p.nbrThreads, multiprocessing.cpu_count()))
+        self.lock = threading.Lock()
+        self.unsupported = set()
+        self.warned = False
+
+    def localChecksum(self, path, bytesPerCrc, crcPerBlock, crcType):
+        if self.cache != None:
+            st = os.stat(path)
+            params = "{0}:{1}:{2}".format(bytesPerCrc, crcPerBlock, crcType)
+            md5 = self.cache.get(st, params)
+            if md5 != None:
+                return md5
+        args = (path, bytesPerCrc, crcPerBlock, crcType)
+        if self.hashPool == None:
+            md5 = fastio.offload(localChecksum, *args)
+        else:
+            md5 = self.hashPool.apply(localChecksum, args)
+        if self.cache != None:
+            self.cache.put(st, params, md5)
+        return md5
+
+    def differs(self, f):
+        """ Return True if content differs, False if same, or None if it can't be compared """
+        hdfsPath = os.path.join(self.hdfsRoot, f)
+        fileChecksum = self.webHDFS.getFileChecksum(hdfsPath)
+        if fileChecksum == None:
+            return True     # Gone or no access. Let the copy tell
+        parsed = parseChecksum(fileChecksum)
+        if parsed == None:
+            with self.lock:
+                if fileChecksum['algorithm'] not in self.unsupported:
+                    self.unsupported.add(fileChecksum['algorithm'])
+                    logger.warning("Checksum algorithm '{0}' can't be compared. Comparing size and modification time instead".format(fileChecksum['algorithm']))
+            return None
+        (bytesPerCrc, crcPerBlock, crcType, md5) = parsed
+        if crcType == "CRC32C" and not HAS_CRC32C:
+            with self.lock:
+                if not self.warned:
+                    self.warned = True
+                    logger.warning("'crc32c' package is not installed. Local CRC32C checksums will be slow")
+        return self.localChecksum(os.path.join(self.localRoot, f), bytesPerCrc, crcPerBlock, crcType) != md5
+
+    def close(self):
+        if self.hashPool != None:
+            self.hashPool.close()
+            self.hashPool.join()
+
+
+def comparePlan(plan, srcTree, destTree, localRoot, hdfsRoot, webHDFS, cache, p):
+    """
+    Compare content of plan['filesToCompare'] (by nbrThreads threads). Differing ones are added to 'filesToReplace'.
+    Others to 'filesToAdjust', if their attributes differ. cache: A ChecksumCache of local files, or None
+    """
+    if len(plan['filesToCompare']) == 0:
+        return
+    startTime = time.time()
+    comparator = Comparator(webHDFS, localRoot, hdfsRoot, cache, p)
+    lock = threading.Lock()
+    counts = { 'differs': 0 }
+    def compare(f):
+        try:
+            differs = comparator.differs(f)
+        except (IOError, OSError, SystemExit) as e:
+            # Removed or unreadable since the walk, or a failed HDFS call (SystemExit: Already printed by misc.ERROR()). Let the copy tell
+            logger.warning("'{0}': Unable to compare by checksum{1}. Will be copied".format(f, "" if isinstance(e, SystemExit) else " ({0})".format(e)))
+            differs = True
+        if differs == None:
+            differs = srcTree['files'][f]['modificationTime'] != destTree['files'][f]['modificationTime']
+        with lock:
+            if differs:
+                plan['filesToReplace'].append(f)
+                counts['differs'] += 1
+            elif planner.checkAttrOnExistingFile(destTree['files'][f], p):
+                plan['filesToAdjust'].append(f)
+    pool = WorkerPool(p.nbrThreads, "checksum")
+    for f in plan['filesToCompare']:
+        pool.submit(compare, f)
+    try:
+        pool.join()
+    finally:
+        comparator.close()
+    logger.info("{0} files compared by checksum in {1:.1f}s. Content differs for {2}".format(len(plan['filesToCompare']), time.time() - startTime, counts['differs']))
+    if cache != None:
+        logger.info("{0} local checksums served from checksum cache, {1} computed".format(cache.hits, cache.misses))
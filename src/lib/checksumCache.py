@@ -0,0 +1,95 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import hashlib
+import sqlite3
+import threading
+import misc
+
+"""
+A cache of the checksums of local files (--compare checksum), stored in a SQLite file per local root path.
+
+A checksum is stored with the device, inode, size, modification time and change time of its file, and with the
+parameters (bytes per CRC, CRCs per block and CRC type) it was computed with. It is reused as long as all of them are
+unchanged. So only new or modified files are read again. The change time catch files rewritten with their modification
+time restored (touch -r, cp -p, rsync -t, ...), which --compare checksum is about.
+
+While walking the local tree, all (device, inode) are recorded. Checksums of files not seen (removed) are then evicted.
+
+A single connection is shared by all threads, under a lock. Changes are committed every COMMIT_PERIOD checksums,
+so an interrupted run does not lose all of them.
+"""
+
+COMMIT_PERIOD = 1000
+
+
+class ChecksumCache:
+
+    def __init__(self, cacheDir, rroot):
+        misc.ensureFolder(cacheDir)
+        key = hashlib.sha1(os.path.abspath(rroot)).hexdigest()
+        self.path = os.path.join(cacheDir, key + ".db")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS checksum (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, ctime REAL, params TEXT, md5 TEXT, PRIMARY KEY (dev, ino))")
+        self.db.execute("CREATE TEMP TABLE seen (dev INTEGER, ino INTEGER, PRIMARY KEY (dev, ino))")
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+    def see(self, stats):
+        """ Record the files (as stat results) found by the walk """
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO seen (dev, ino) VALUES (?, ?)", [ (st.st_dev, st.st_ino) for st in stats ])
+
+    def evict(self):
+        """ Once the walk is done: Drop the checksums of files not seen. Return their number """
+        with self.lock:
+            count = self.db.execute("DELETE FROM checksum WHERE NOT EXISTS (SELECT 1 FROM seen WHERE seen.dev = checksum.dev AND seen.ino = checksum.ino)").rowcount
+            self.db.execute("DELETE FROM seen")
+            self.db.commit()
+        return count
+
+    def get(self, st, params):
+        """ Return the checksum of the file (as stat result) computed with params, or None if not in cache or modified since """
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, ctime, params, md5 FROM checksum WHERE dev = ? AND ino = ?", (st.st_dev, st.st_ino)).fetchone()
+            if row == None or row[0:4] != (st.st_size, st.st_mtime, st.st_ctime, params):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[4]
+
+    def put(self, st, params, md5):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO checksum (dev, ino, size, mtime, ctime, params, md5) VALUES (?, ?, ?, ?, ?, ?, ?)", (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime, params, md5))
+            self.pending += 1
+            if self.pending >= COMMIT_PERIOD:
+                self.db.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def lookup(p, rroot):
+    """ Return the checksum cache for this local tree, or None if not enabled """
+    if p.checksumCache == None or p.compare != "checksum":
+        return None
+    return ChecksumCache(p.checksumCache, rroot)
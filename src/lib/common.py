@@ -16,7 +16,9 @@ import os
 import misc
 import argparse
 from threading import Thread
+import threading
 import time
+import Queue
 
 
 
@@ -32,7 +34,12 @@ def parseArg(mydir):
     parser.add_argument('--report', action='store_true')
     parser.add_argument('--reportFiles', action='store_true')
     parser.add_argument('--nbrThreads', required=False)
+    parser.add_argument('--adaptive', action='store_true', help="Adjust the number of active copy threads at runtime, between --minThreads and --nbrThreads, from observed latency, throughput and errors")
+    parser.add_argument('--minThreads', required=False, type=int, default=1, help="With --adaptive: Lower bound (and starting value) of active copy threads. Default: 1")
+    parser.add_argument('--nbrProcesses', required=False, type=int, default=1, help="Number of processes sharing the files copy, each with nbrThreads threads. Default: 1")
+    parser.add_argument('--nbrListingThreads', required=False, help="Number of concurrent directory listings while building trees. Default: 1")
     parser.add_argument('--yamlLoggingConf', help="Logging configuration as a yaml file")
+    parser.add_argument('--planBudget', required=False, type=int, default=1000000, help="Max number of entries of each files list kept in memory while planning. Default: 1000000")
 
     parser.add_argument('--force',  action='store_true')
     parser.add_argument('--backup', action='store_true')
@@ -48,6 +55,23 @@ def parseArg(mydir):
     parser.add_argument('--hdfsUser', required=False, default="hdfs", help="Default: 'hdfs'. Set to 'KERBEROS' to use Kerberos authentication")
     parser.add_argument('--hadoopConfDir', required=False, default="/etc/hadoop/conf")
     parser.add_argument('--webhdfsEndpoint', required=False)
+    parser.add_argument('--watch', action='store_true', help="hdfsput: After initial copy, keep watching src for changes")
+    parser.add_argument('--debounce', required=False, type=float, default=2.0, help="With --watch: Delay (in seconds) without change before copying a batch of changes. Default: 2")
+    parser.add_argument('--rescanPeriod', required=False, type=int, default=300, help="With --watch: Full rescan period when inotify is not usable. Default: 300")
+    parser.add_argument('--multipartThreshold', required=False, type=int, help="Files bigger than this size (in bytes) are transferred by parts, in parallel. Default: No multipart transfer")
+    parser.add_argument('--blockSize', required=False, type=int, default=134217728, help="HDFS block size, for multipart transfers. Default: 134217728")
+    parser.add_argument('--chunkSize', required=False, type=int, default=1048576, help="Size of the blocks read or written on local files during transfers. Default: 1048576")
+    parser.add_argument('--datanodeStreams', required=False, type=int, help="hdfsget: Spread reads on datanodes, with at most this number of concurrent streams per datanode. Default: Let the namenode choose")
+    parser.add_argument('--engine', required=False, choices=['threads', 'gevent'], default="threads", help="Run workers as OS threads, or as greenlets on a single event loop. Default: threads")
+    parser.add_argument('--compare', required=False, choices=['mtime', 'checksum'], default="mtime", help="Compare files of same size by modification time, or by content (HDFS checksum). Default: mtime")
+    parser.add_argument('--checksumCache', required=False, help="With --compare checksum: Folder to store a cache of local files checksums. Enable checksum cache")
+    parser.add_argument('--verify', action='store_true', help="Check each copied file against its HDFS checksum, computed during the transfer. Copy it again on mismatch")
+    parser.add_argument('--prune', action='store_true', help="Do not walk HDFS subtrees with same files count, directories count and size than the other side")
+    parser.add_argument('--listingCache', required=False, help="Folder to store a cache of HDFS directories listing. Enable listing cache")
+    parser.add_argument('--journal', required=False, help="hdfsput: File recording the plan and the completed operations, so an interrupted run can be finished with --resume")
+    parser.add_argument('--resume', action='store_true', help="hdfsput: With --journal: Finish the interrupted run recorded in the journal, without walking trees")
+    parser.add_argument('--retries', required=False, type=int, default=5, help="Number of retries of a failed HDFS request (connection error, timeout, 5xx), with exponential backoff. Interrupted transfers are resumed. Default: 5")
+    parser.add_argument('--timeout', required=False, type=float, default=300, help="Timeout (in seconds) of HDFS connections, and of each read on them. Default: 300")
 
     params = parser.parse_args()
     
@@ -58,7 +82,12 @@ def parseArg(mydir):
     p.report = params.report
     p.reportFiles = params.reportFiles
     p.nbrThreads = params.nbrThreads
+    p.adaptive = params.adaptive
+    p.minThreads = params.minThreads
+    p.nbrProcesses = params.nbrProcesses
+    p.nbrListingThreads = params.nbrListingThreads
     p.yamlLoggingConf = params.yamlLoggingConf
+    p.planBudget = params.planBudget
     
     p.force = params.force
     p.backup = params.backup
@@ -70,6 +99,23 @@ def parseArg(mydir):
     p.hdfsUser = params.hdfsUser
     p.hadoopConfDir = params.hadoopConfDir
     p.webhdfsEndpoint = params.webhdfsEndpoint
+    p.listingCache = params.listingCache
+    p.prune = params.prune
+    p.compare = params.compare
+    p.checksumCache = params.checksumCache
+    p.verify = params.verify
+    p.multipartThreshold = params.multipartThreshold
+    p.blockSize = params.blockSize
+    p.chunkSize = params.chunkSize
+    p.datanodeStreams = params.datanodeStreams
+    p.engine = params.engine
+    p.watch = params.watch
+    p.debounce = params.debounce
+    p.rescanPeriod = params.rescanPeriod
+    p.journal = params.journal
+    p.resume = params.resume
+    p.retries = params.retries
+    p.timeout = params.timeout
     
     
     p.loggingConfFile =  os.path.join(mydir, "./logging.yml")
@@ -82,10 +128,33 @@ def parseArg(mydir):
         p.nbrThreads = int(p.nbrThreads)
     else:
         p.nbrThreads = 1
+
+    if p.nbrListingThreads != None:
+        p.nbrListingThreads = int(p.nbrListingThreads)
+    else:
+        p.nbrListingThreads = 1
         
     if p.reportFiles:
         p.report = True
 
+    if p.adaptive and not 1 <= p.minThreads <= p.nbrThreads:
+        misc.ERROR("minThreads must be between 1 and nbrThreads")
+
+    if p.resume and p.journal == None:
+        misc.ERROR("--resume requires --journal")
+    if p.journal != None and p.watch:
+        misc.ERROR("--journal and --watch are mutually exclusive")
+
+    if p.retries < 0:
+        misc.ERROR("retries must be at least 0")
+    if p.timeout <= 0:
+        misc.ERROR("timeout must be positive")
+
+    if p.nbrProcesses < 1:
+        misc.ERROR("nbrProcesses must be at least 1")
+    if p.nbrProcesses > 1 and p.engine == "gevent":
+        misc.ERROR("--nbrProcesses and --engine gevent are mutually exclusive")
+
     # Some checks    
     if p.mode != None:
         if not isinstance(p.mode, int):
@@ -100,18 +169,94 @@ def parseArg(mydir):
 
 
 
+def getPartSize(size, p):
+    """ Size of the parts of a file transferred by parts: About nbrThreads parts, of a whole number of blocks """
+    if p.multipartThreshold == None or size <= p.multipartThreshold:
+        return size
+    nbrBlocks = (size + p.blockSize - 1) // p.blockSize
+    return ((nbrBlocks + p.nbrThreads - 1) // p.nbrThreads) * p.blockSize
+
+
 class StatsThread(Thread):
-    def __init__(self, queue, myThreads):
+    """ 
+    Print the number of files copied by the given threads (Using their 'fileCount'), every 2 seconds up to stop().
+    Errors are also printed, from threads 'errorCount'.
+    """
+    def __init__(self, threads, nbrFiles):
         Thread.__init__(self)
-        self.queue = queue
-        self.myThreads = myThreads
-        self.allFiles = queue.qsize()
+        self.threads = threads
+        self.nbrFiles = nbrFiles
+        self.stopped = threading.Event()
     
     def run(self):
         while True:
-            x = self.queue.qsize()
-            print("hdfsmirror: {0}/{1} new files copied".format(self.allFiles - x, self.allFiles))
-            if x == 0 or  len(self.myThreads) <= 1: # If 1, this is myself. So, exit. (This is in error case, where all threads died while queue is not empty)
+            x = sum(t.fileCount for t in self.threads)
+            errors = sum(getattr(t, 'errorCount', 0) for t in self.threads)
+            if errors > 0:
+                print("hdfsmirror: {0}/{1} new files copied, {2} errors".format(x, self.nbrFiles, errors))
+            else:
+                print("hdfsmirror: {0}/{1} new files copied".format(x, self.nbrFiles))
+            if self.stopped.wait(2):
                 return
-            time.sleep(2)
+
+    def stop(self):
+        self.stopped.set()
+
+
+
+class WorkerPool:
+    """
+    A fixed set of threads executing submitted tasks. A task may submit other tasks.
+    join() wait for all tasks (including the ones submitted later) to be completed.
+    
+    An error in a task (including misc.ERROR(), which raise SystemExit) is recorded. Remaining tasks are then
+    skipped and the error is raised again by join(), in the calling thread.
+    With keepGoing, remaining tasks are run anyway, and join() fails with the number of errors. Tasks are then
+    expected to log their own errors.
+    If a limiter (concurrency.Limiter) is provided, tasks are run under it.
+    """
+    def __init__(self, nbrThreads, name, limiter=None, keepGoing=False):
+        self.queue = Queue.Queue()
+        self.name = name
+        self.limiter = limiter
+        self.keepGoing = keepGoing
+        self.errors = []
+        self.threads = []
+        for i in range(0, nbrThreads):
+            t = Thread(target=self.work, name="{0}#{1}".format(name, i))
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+    
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
         
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task == None:
+                self.queue.task_done()
+                return
+            (fn, args) = task
+            try:
+                if self.keepGoing or not self.errors:
+                    if self.limiter != None:
+                        with self.limiter:
+                            fn(*args)
+                    else:
+                        fn(*args)
+            except (Exception, SystemExit) as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        self.queue.join()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            if self.keepGoing:
+                misc.ERROR("{0} {1} errors", len(self.errors), self.name)
+            raise self.errors[0]
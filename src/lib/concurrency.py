@@ -0,0 +1,209 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import threading
+import multiprocessing
+import time
+import logging
+from urlparse import urlparse
+
+logger = logging.getLogger("hdfsmirror.concurrency")
+
+"""
+Adaptive concurrency (--adaptive).
+
+--nbrThreads copy threads (and metadata threads, for hdfsput) are started, but only 'limit' of them can be active at a
+time (Limiter). A controller adjust this limit every PERIOD seconds, between --minThreads and --nbrThreads, AIMD-style:
+
+- The limit is halved on overload: A 503 (or other 5xx) response, or a connection error.
+- It is reduced by a quarter when the namenode latency (average time to response headers, on namenode requests only,
+  as datanode ones include the data transfer) is more than LATENCY_FACTOR times the best seen so far.
+- Otherwise, if a thread had to wait for a slot (so more concurrency was usable) and the throughput did not drop by
+  more than TOLERANCE, the limit is increased. It is doubled up to the first decrease (slow start), then increased by 1.
+
+A window with less than MIN_SAMPLES namenode requests does not tell anything on latency. Each change is logged.
+
+Requests are observed on the HTTP sessions of WebHDFS (Monitor). With --nbrProcesses, each process has its own
+controller, with the same bounds.
+"""
+
+PERIOD = 5
+LATENCY_FACTOR = 2.0
+TOLERANCE = 0.1
+MIN_SAMPLES = 10
+
+
+class Limiter:
+    """ Bound the number of threads inside 'with limiter:' blocks. No bound if limit is None """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.active = 0
+        self.saturated = False   # Did a thread wait, since last check
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        if self.limit == None:
+            return
+        with self.condition:
+            if self.active >= self.limit:
+                self.saturated = True
+                while self.active >= self.limit:
+                    self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *args):
+        if self.limit == None:
+            return
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def setLimit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def takeSaturated(self):
+        with self.condition:
+            saturated = self.saturated or self.active >= self.limit
+            self.saturated = False
+            return saturated
+
+
+class Monitor:
+    """ Response hook of HTTP sessions (See sessionPool.py). Count requests, overloads and namenode latency """
+    def __init__(self, namenode):
+        self.namenode = namenode
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.overloads = 0
+        self.errors = 0
+        self.samples = 0
+        self.latency = 0.0
+
+    def onResponse(self, resp, *args, **kwargs):
+        with self.lock:
+            self.requests += 1
+            if resp.status_code >= 500:
+                self.overloads += 1
+            if urlparse(resp.url).netloc == self.namenode:
+                self.samples += 1
+                self.latency += resp.elapsed.total_seconds()
+
+    def onError(self):
+        with self.lock:
+            self.errors += 1
+
+    def take(self):
+        """ Return (requests, overloads, errors, namenode samples, average namenode latency) since last call """
+        with self.lock:
+            window = (self.requests, self.overloads, self.errors, self.samples, self.latency / self.samples if self.samples > 0 else None)
+            self.reset()
+            return window
+
+
+class Controller(threading.Thread):
+    def __init__(self, webHDFS, minimum, maximum):
+        threading.Thread.__init__(self, name="concurrency")
+        self.daemon = True
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = minimum
+        self.limiters = {}
+        self.threads = []
+        self.lastBytes = 0
+        self.lastFiles = 0
+        self.throughput = None
+        self.bestLatency = None
+        self.slowStart = True
+        self.lock = threading.Lock()
+        self.monitor = Monitor(webHDFS.endpoint)
+        webHDFS.pool.monitor = self.monitor
+        process = multiprocessing.current_process()
+        self.prefix = "" if process.name == "MainProcess" else "{0}: ".format(process.name)
+
+    def limiter(self, name):
+        """ The limiter of a set of threads (i.e. "copy", "metadata"), following the limit of this controller """
+        with self.lock:
+            if name not in self.limiters:
+                self.limiters[name] = Limiter(self.limit)
+            return self.limiters[name]
+
+    def follow(self, threads):
+        """ Measure throughput on these threads 'byteCount' and 'fileCount' """
+        with self.lock:
+            self.threads = threads
+            self.lastBytes = 0
+            self.lastFiles = 0
+
+    def run(self):
+        lastTime = time.time()
+        while True:
+            time.sleep(PERIOD)
+            now = time.time()
+            with self.lock:
+                byteCount = sum(t.byteCount for t in self.threads)
+                fileCount = sum(t.fileCount for t in self.threads)
+                throughput = (byteCount - self.lastBytes) / (now - lastTime)
+                fileRate = (fileCount - self.lastFiles) / (now - lastTime)
+                (self.lastBytes, self.lastFiles) = (byteCount, fileCount)
+                saturated = any([ limiter.takeSaturated() for limiter in self.limiters.values() ])
+            lastTime = now
+            window = self.monitor.take()
+            if window[0] > 0 or throughput > 0:
+                self.adjust(window, throughput, fileRate, saturated)
+
+    def adjust(self, window, throughput, fileRate, saturated):
+        (requests, overloads, errors, samples, latency) = window
+        if samples >= MIN_SAMPLES and (self.bestLatency == None or latency < self.bestLatency):
+            self.bestLatency = latency
+        limit = self.limit
+        if overloads > 0 or errors > 0:
+            limit = self.limit // 2
+            reason = "overload"
+        elif samples >= MIN_SAMPLES and latency > LATENCY_FACTOR * self.bestLatency:
+            limit = self.limit - max(1, self.limit // 4)
+            reason = "namenode latency"
+        elif saturated and (self.throughput == None or throughput >= (1 - TOLERANCE) * self.throughput):
+            limit = self.limit * 2 if self.slowStart else self.limit + 1
+            reason = "slow start" if self.slowStart else "increase"
+        limit = max(self.minimum, min(self.maximum, limit))
+        self.throughput = throughput
+        if limit == self.limit:
+            return
+        if limit < self.limit:
+            self.slowStart = False
+        logger.info("{0}Active threads: {1} -> {2} ({3}). {4:.1f} MB/s, {5:.1f} files/s, {6} requests, {7} overloads, {8} errors, namenode latency: {9}".format(self.prefix, self.limit, limit, reason, throughput / 1048576.0, fileRate, requests, overloads, errors, "{0:.3f}s".format(latency) if latency != None else "-"))
+        with self.lock:
+            self.limit = limit
+            for limiter in self.limiters.values():
+                limiter.setLimit(limit)
+
+
+def lookup(p, webHDFS):
+    """ Return a started controller on webHDFS requests, or None if not enabled """
+    if not p.adaptive:
+        return None
+    controller = Controller(webHDFS, p.minThreads, p.nbrThreads)
+    controller.start()
+    return controller
+
+
+def limiterOf(controller, name, limit=None):
+    """ The named limiter of the controller, or one bounded to limit (None: unbounded) if no controller """
+    return controller.limiter(name) if controller != None else Limiter(limit)
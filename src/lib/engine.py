@@ -0,0 +1,54 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import threading
+import misc
+import fastio
+
+try:
+    import gevent
+    import gevent.monkey
+    HAS_GEVENT = True
+except ImportError:
+    HAS_GEVENT = False
+
+"""
+Transfer engines (--engine):
+
+- 'threads': Each copy, listing and metadata worker is an OS thread.
+
+- 'gevent': The same workers run as greenlets, on a single event loop (gevent monkey patching of socket, select,
+  threading, ...). So --nbrThreads can be raised to hundreds or thousands, to hide the namenode latency on small files,
+  without the memory and GIL cost of OS threads. The number of workers still bound the number of requests in flight.
+  Blocking local file I/O (fastio) is run on a pool of IO_THREADS OS threads, not to stall the loop.
+
+As the code run is the same, plans and results are the same with both engines.
+"""
+
+IO_THREADS = 8
+
+
+def setup(p):
+    """ To be called before any thread, lock or connection is created """
+    if p.engine != "gevent":
+        return
+    if not HAS_GEVENT:
+        misc.ERROR("'gevent' package is not installed")
+    gevent.monkey.patch_all()
+    pool = gevent.get_hub().threadpool
+    pool.maxsize = IO_THREADS
+    fastio.offload = lambda fn, *args: pool.apply(fn, args)
+    # Created at import, so with the OS thread-local. Must be per greenlet
+    fastio.buffers = threading.local()
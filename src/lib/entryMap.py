@@ -0,0 +1,177 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import izip
+
+"""
+A compact replacement of the { <relative path>: { 'size': ..., 'modificationTime': ..., 'mode': ..., 'owner': ..., 'group': ... } }
+dicts of a tree (See buildTree.py), aimed to hold several millions of entries.
+
+- Attributes are stored by columns, in arrays of machine integers, one slot per entry.
+- owner, group and mode strings are interned in a table shared by all maps, and referenced by index.
+- Paths are split in <directory prefix>/<name>. Each prefix is stored once, with a { name: row } dict.
+- Once loaded, freeze() replace these dicts by a sorted tuple of names and an array of rows (Looked up by bisection).
+  A frozen directory is transparently turned back to a dict on insertion.
+
+It behave like a dict (in, [], get(), iteration, len(), iteritems()), except values are built on each access.
+So, modifying a returned status has no effect. Store it back instead.
+"""
+
+FILE_FIELDS = ('size', 'modificationTime', 'mode', 'owner', 'group')
+DIRECTORY_FIELDS = ('mode', 'owner', 'group')
+
+STRING_FIELDS = ('mode', 'owner', 'group')
+
+
+class StringTable:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.strings = []
+        self.index = {}
+
+    def idOf(self, s):
+        i = self.index.get(s)
+        if i == None:
+            with self.lock:
+                i = self.index.get(s)
+                if i == None:
+                    i = len(self.strings)
+                    self.strings.append(s)
+                    self.index[s] = i
+        return i
+
+strings = StringTable()
+
+
+class EntryMap:
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.columns = []
+        for field in fields:
+            if field in STRING_FIELDS:
+                self.columns.append((field, array('i'), True))
+            else:
+                self.columns.append((field, array('l'), False))
+        self.dirs = {}
+        self.count = 0
+
+    def rowOf(self, key):
+        i = key.rfind('/') + 1
+        names = self.dirs.get(key[:i])
+        if names == None:
+            return None
+        if type(names) is dict:
+            return names.get(key[i:])
+        (sortedNames, rows) = names
+        name = key[i:]
+        j = bisect_left(sortedNames, name)
+        if j < len(sortedNames) and sortedNames[j] == name:
+            return rows[j]
+        return None
+
+    def statusOf(self, row):
+        status = {}
+        for (field, column, interned) in self.columns:
+            if interned:
+                status[field] = strings.strings[column[row]]
+            else:
+                status[field] = column[row]
+        return status
+
+    def __setitem__(self, key, status):
+        i = key.rfind('/') + 1
+        prefix = key[:i]
+        names = self.dirs.get(prefix)
+        if names == None:
+            names = self.dirs[prefix] = {}
+        elif type(names) is not dict:
+            names = self.dirs[prefix] = dict(izip(names[0], names[1]))
+        name = key[i:]
+        row = names.get(name)
+        if row == None:
+            names[name] = self.count
+            self.count += 1
+            for (field, column, interned) in self.columns:
+                column.append(strings.idOf(status[field]) if interned else status[field])
+        else:
+            for (field, column, interned) in self.columns:
+                column[row] = strings.idOf(status[field]) if interned else status[field]
+
+    def __getitem__(self, key):
+        row = self.rowOf(key)
+        if row == None:
+            raise KeyError(key)
+        return self.statusOf(row)
+
+    def get(self, key, default=None):
+        row = self.rowOf(key)
+        if row == None:
+            return default
+        return self.statusOf(row)
+
+    def __contains__(self, key):
+        return self.rowOf(key) != None
+
+    def __len__(self):
+        return self.count
+
+    def iterRows(self, names):
+        if type(names) is dict:
+            return names.iteritems()
+        return izip(names[0], names[1])
+
+    def __iter__(self):
+        for (prefix, names) in self.dirs.iteritems():
+            for (name, _) in self.iterRows(names):
+                yield prefix + name
+
+    def iteritems(self):
+        for (prefix, names) in self.dirs.iteritems():
+            for (name, row) in self.iterRows(names):
+                yield (prefix + name, self.statusOf(row))
+
+    def itersorted(self):
+        """ Yield ((<prefix>, <name>), status), ordered by directory prefix, then name. So, parents come before children. """
+        for prefix in sorted(self.dirs):
+            names = self.dirs[prefix]
+            if type(names) is dict:
+                rows = sorted(names.iteritems())
+            else:
+                rows = izip(names[0], names[1])
+            for (name, row) in rows:
+                yield ((prefix, name), self.statusOf(row))
+
+    def freeze(self, prefix=None):
+        """ Freeze all directories, or only the given one ('' for top level, 'a/b/' for a/b) """
+        if prefix == None:
+            prefixes = self.dirs.keys()
+        else:
+            prefixes = [prefix]
+        for prefix in prefixes:
+            names = self.dirs.get(prefix)
+            if type(names) is dict:
+                sortedNames = sorted(names)
+                self.dirs[prefix] = (tuple(sortedNames), array('i', (names[name] for name in sortedNames)))
+
+    def keys(self):
+        return list(self)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
@@ -0,0 +1,222 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import threading
+import ctypes
+import ctypes.util
+
+"""
+Local file I/O, for transfers.
+
+Upload: FileBody is a request body reading the file by large blocks (readinto()) in a per-thread buffer, reused for all
+blocks. httplib send the buffer as is, whatever the block size it asked for.
+
+Download: An HTTP response is copied by large blocks: It is read (readinto()) in the same per-thread buffer, and written
+at its offset with pwrite(), without intermediate string. So several threads can fill the same file.
+
+With the libc (Linux), the file is preallocated with posix_fallocate(). Each WINDOW bytes, writeback of the window is
+started (sync_file_range()), and the previous one is dropped from the page cache (posix_fadvise(DONTNEED)) once written.
+So a huge download does not evict everything else. Times are set with futimens().
+
+Without the libc, plain python calls are used instead.
+
+Blocking calls go through offload(), so the gevent engine can run them out of its event loop (See engine.py).
+"""
+
+WINDOW = 64 * 1024 * 1024
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def bind(name, argtypes):
+    """ Return the libc function, or None if not available """
+    f = getattr(libc, name, None)
+    if f != None:
+        f.argtypes = argtypes
+    return f
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+except OSError:
+    libc = None
+
+pwrite = bind("pwrite64", [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64])
+fallocate = bind("posix_fallocate64", [ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+fadvise = bind("posix_fadvise64", [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int])
+syncFileRange = bind("sync_file_range", [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint])
+futimens = bind("futimens", [ctypes.c_int, ctypes.POINTER(Timespec)])
+if pwrite != None:
+    pwrite.restype = ctypes.c_ssize_t
+
+
+buffers = threading.local()
+
+def offload(fn, *args):
+    """ Run a blocking local I/O. Replaced by engine.setup() to run it out of the event loop """
+    return fn(*args)
+
+def getBuffer(size):
+    """ Return (data, view, address) of the buffer (a bytearray) of the calling thread """
+    if not hasattr(buffers, "view") or len(buffers.view) != size:
+        buffers.data = bytearray(size)
+        buffers.view = memoryview(buffers.data)
+        buffers.address = ctypes.addressof(ctypes.c_char.from_buffer(buffers.data))
+    return (buffers.data, buffers.view, buffers.address)
+
+
+class LocalFile:
+
+    def __init__(self, path, size):
+        """ Create (or truncate) the file, and allocate it to its final size """
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.fd = offload(self.create, size)
+
+    def create(self, size):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        if size > 0:
+            if fallocate == None or fallocate(fd, 0, size) != 0:
+                os.ftruncate(fd, size)
+        if fadvise != None:
+            fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        return fd
+
+    def copyFrom(self, stream, offset, chunkSize, digest=None):
+        """
+        Copy stream (a file-like object, with readinto()) at offset, by chunkSize blocks. Return the number of bytes copied
+        If digest (a checksum.Digest) is provided, data is fed to it on the way.
+        """
+        (data, view, address) = getBuffer(chunkSize)
+        position = offset
+        windowStart = offset
+        previous = None
+        while True:
+            n = stream.readinto(view)
+            if n == 0:
+                break
+            offload(self.write, view, address, n, position)
+            if digest != None:
+                offload(digest.update, data, n)
+            position += n
+            if position - windowStart >= WINDOW:
+                offload(self.flush, windowStart, position - windowStart)
+                if previous != None:
+                    offload(self.drop, *previous)
+                previous = (windowStart, position - windowStart)
+                windowStart = position
+        if previous != None:
+            offload(self.drop, *previous)
+        return position - offset
+
+    def write(self, view, address, n, position):
+        if pwrite == None:
+            # No positional write. Serialize seek and write
+            with self.lock:
+                os.lseek(self.fd, position, os.SEEK_SET)
+                written = 0
+                while written < n:
+                    written += os.write(self.fd, view[written:n])
+            return
+        written = 0
+        while written < n:
+            r = pwrite(self.fd, address + written, n - written, position + written)
+            if r < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, "pwrite({0}): {1}".format(self.path, os.strerror(err)))
+            written += r
+
+    def flush(self, offset, length):
+        """ Start writing back a range """
+        if syncFileRange != None:
+            syncFileRange(self.fd, offset, length, SYNC_FILE_RANGE_WRITE)
+
+    def drop(self, offset, length):
+        """ Wait for a range to be written back, and drop it from the page cache """
+        if syncFileRange != None:
+            syncFileRange(self.fd, offset, length, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+        if fadvise != None:
+            fadvise(self.fd, offset, length, POSIX_FADV_DONTNEED)
+
+    def setTimes(self, atime, mtime):
+        if futimens == None:
+            os.utime(self.path, (atime, mtime))
+            return
+        times = (Timespec * 2)(Timespec(int(atime), 0), Timespec(int(mtime), 0))
+        if futimens(self.fd, times) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "futimens({0}): {1}".format(self.path, os.strerror(err)))
+
+    def chown(self, uid, gid):
+        os.fchown(self.fd, uid, gid)
+
+    def chmod(self, mode):
+        os.fchmod(self.fd, mode)
+
+    def close(self):
+        if fadvise != None:
+            # Remaining pages are dropped once written back by the kernel
+            fadvise(self.fd, 0, 0, POSIX_FADV_DONTNEED)
+        os.close(self.fd)
+
+
+class FileBody:
+    """
+    Request body sending 'length' bytes of a file from 'offset', by chunkSize blocks. Has a len(), so requests send it
+    with a Content-Length, not chunked.
+    A block is valid until next read(). Not a concern, as httplib send it before reading the next one.
+    If digest (a checksum.Digest) is provided, blocks are fed to it as they are read.
+    """
+    def __init__(self, path, chunkSize, offset=0, length=None, digest=None):
+        self.f = open(path, "rb")
+        if length == None:
+            length = os.fstat(self.f.fileno()).st_size - offset
+        self.f.seek(offset)
+        self.remaining = length
+        self.chunkSize = chunkSize
+        self.digest = digest
+        if fadvise != None:
+            fadvise(self.f.fileno(), offset, length, POSIX_FADV_SEQUENTIAL)
+
+    def __len__(self):
+        return self.remaining
+
+    def read(self, size=-1):
+        """ size is ignored. Return a chunkSize block (or less at end of file) """
+        (data, view, _) = getBuffer(self.chunkSize)
+        n = offload(self.f.readinto, view[:min(self.chunkSize, self.remaining)])
+        self.remaining -= n
+        if self.digest != None:
+            offload(self.digest.update, data, n)
+        return view[:n]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,95 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+"""
+A minimal binding of the Linux inotify API, through ctypes. HAS_INOTIFY is False on other systems.
+"""
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    HAS_INOTIFY = True
+except (OSError, AttributeError):
+    HAS_INOTIFY = False
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+
+    def __init__(self):
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: " + os.strerror(ctypes.get_errno()))
+
+    def addWatch(self, path, mask):
+        """ Return the watch descriptor. Adding a watch on an already watched inode return the same descriptor. """
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_add_watch({0}): {1}".format(path, os.strerror(err)))
+        return wd
+
+    def removeWatch(self, wd):
+        libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """ Return a list of (wd, mask, cookie, name). Empty if nothing happened within timeout (in seconds) """
+        try:
+            (readable, _, _) = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        data = os.read(self.fd, 256 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,227 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import marshal
+import threading
+import logging
+import misc
+import fastio
+import planner
+import buildTree
+
+logger = logging.getLogger("hdfsmirror.journal")
+
+"""
+Run journal of hdfsput (--journal), to finish an interrupted run without walking and comparing trees again (--resume).
+
+An append-only file of marshal records:
+- Once built, the plan is recorded: A header with the options it depends on, then one record per operation, then a
+  'planned' record. These are synced before any operation starts.
+- Each operation is then recorded once done: A directory created (with its attributes), a file copied (with its
+  modification time and attributes set), a file or directory attributes adjusted. Backups are also recorded, so a
+  file is not renamed twice.
+- An 'end' record closes a completed run.
+
+Records are queued by the worker threads, and written with a single write() and fsync() every SYNC_PERIOD seconds
+by a background thread. So workers never wait for the disk. A killed run lose at most the last SYNC_PERIOD seconds
+of records: These operations are done again on resume. A record cut by the interruption ends the journal, and is
+truncated before appending to it again.
+
+On --resume, the plan and its options are read back, minus the operations done. Source and target are assumed
+unchanged since the plan was built. As a file of the plan may have been partially copied, files are copied with
+overwrite.
+
+Copy processes (--nbrProcesses) append to the same file, each through its own O_APPEND descriptor.
+"""
+
+SYNC_PERIOD = 1
+VERSION = 1
+
+# Options the plan depends on. Restored from the journal on --resume
+PLAN_OPTIONS = ('force', 'forceExt', 'backup', 'owner', 'group', 'mode', 'directoryMode')
+
+OPERATIONS = ('mkdir', 'file', 'adjustFile', 'adjustDirectory')
+
+
+class Journal:
+
+    def __init__(self, path, truncateAt=None, backedUp=None):
+        """ Open the journal for appending. Truncated to truncateAt bytes (0 for a new journal) if provided """
+        self.path = path
+        self.backedUp = backedUp if backedUp != None else set()  # Files already backed up, on resume
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        if truncateAt != None:
+            os.ftruncate(self.fd, truncateAt)
+        self.lock = threading.Lock()
+        self.syncLock = threading.Lock()
+        self.pending = []
+        self.stopped = threading.Event()
+        self.syncer = threading.Thread(target=self.run, name="journal")
+        self.syncer.daemon = True
+        self.syncer.start()
+
+    def clone(self):
+        """ For a copy process: Own descriptor and syncer thread """
+        return Journal(self.path, None, self.backedUp)
+
+    def record(self, *record):
+        """ Queue a record. Written by next sync() """
+        data = marshal.dumps(record)
+        with self.lock:
+            self.pending.append(data)
+
+    def run(self):
+        while not self.stopped.wait(SYNC_PERIOD):
+            self.sync()
+
+    def sync(self):
+        """ Write queued records, and return once they are on disk """
+        with self.syncLock:
+            with self.lock:
+                data = "".join(self.pending)
+                self.pending = []
+            if len(data) > 0:
+                fastio.offload(self.write, data)
+
+    def write(self, data):
+        while len(data) > 0:
+            n = os.write(self.fd, data)
+            data = data[n:]
+        os.fsync(self.fd)
+
+    def recordPlan(self, p, srcTree, destTree, dest, plan):
+        """ Record the operations of the plan which will be performed. dest: The HDFS target directory. Synced """
+        self.record("plan", VERSION, p.src, p.dest, srcTree['rroot'], dest, dict((option, getattr(p, option)) for option in PLAN_OPTIONS))
+        for d in plan['directoriesToCreate']:
+            self.record("mkdir", d)
+        for f in plan['filesToCreate']:
+            self.record("file", f, srcTree['files'][f], None)
+        if p.force:
+            for f in plan['filesToReplace']:
+                self.record("file", f, srcTree['files'][f], destTree['files'][f])
+        if p.forceExt:
+            for f in plan['filesToAdjust']:
+                self.record("adjustFile", f, destTree['files'][f])
+            for d in plan['directoriesToAdjust']:
+                self.record("adjustDirectory", d, destTree['directories'][d])
+        self.record("planned")
+        self.sync()
+
+    def done(self, operation, path):
+        self.record("done", operation, path)
+
+    def backup(self, f):
+        """ Synced: Renaming again would move our copy over the backup """
+        self.record("backedUp", f)
+        self.sync()
+
+    def close(self):
+        if self.fd == None:
+            return
+        self.stopped.set()
+        self.syncer.join()
+        self.sync()
+        os.close(self.fd)
+        self.fd = None
+
+
+def readRecords(path):
+    """ Yield (record, offset after it), up to the end of the file or to a cut record """
+    with open(path, "rb") as f:
+        while True:
+            try:
+                record = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return
+            yield (record, f.tell())
+
+
+def lookup(p):
+    """ Return a new journal for this run, or None if not enabled """
+    if p.journal == None or p.checkMode:
+        return None
+    return Journal(p.journal, 0)
+
+
+def resume(p):
+    """
+    Read back the journal of an interrupted run, and restore the options of its plan in p.
+    Return (journal, srcTree, destTree, dest, plan): The journal to go on with (None in checkMode), the HDFS target
+    directory and the operations not done yet. srcTree and destTree only hold the entries of these operations.
+    """
+    if not os.path.isfile(p.journal):
+        misc.ERROR("Journal '{0}' not found", p.journal)
+    header = None
+    planned = False
+    ended = False
+    done = set()
+    backedUp = set()
+    validLength = 0
+    for (record, offset) in readRecords(p.journal):
+        if record[0] == "plan":
+            header = record
+        elif record[0] == "planned":
+            planned = True
+        elif record[0] == "done":
+            done.add(record[1:])
+        elif record[0] == "backedUp":
+            backedUp.add(record[1])
+        elif record[0] == "end":
+            ended = True
+        validLength = offset
+    if header == None or not planned:
+        misc.ERROR("Journal '{0}' holds no complete plan. Run without --resume", p.journal)
+    (_, version, src, dest, srcRroot, target, options) = header
+    if version != VERSION:
+        misc.ERROR("Journal '{0}': Unsupported version {1}", p.journal, version)
+    if (src, dest) != (p.src, p.dest):
+        misc.ERROR("Journal '{0}' was recorded for --src {1} --dest {2}", p.journal, src, dest)
+    for (option, value) in options.iteritems():
+        setattr(p, option, value)
+    srcTree = buildTree.buildEmptyTree(srcRroot)
+    destTree = buildTree.buildEmptyTree(target)
+    plan = planner.newPlan(p)
+    total = 0
+    for (record, _) in readRecords(p.journal):
+        if record[0] == "planned":
+            break
+        if record[0] not in OPERATIONS:
+            continue
+        total += 1
+        if (record[0], record[1]) in done:
+            continue
+        if record[0] == "mkdir":
+            plan['directoriesToCreate'].append(record[1])
+        elif record[0] == "file":
+            (f, srcStatus, destStatus) = record[1:]
+            srcTree['files'][f] = srcStatus
+            if destStatus == None:
+                plan['filesToCreate'].append(f)
+            else:
+                destTree['files'][f] = destStatus
+                plan['filesToReplace'].append(f)
+        elif record[0] == "adjustFile":
+            destTree['files'][record[1]] = record[2]
+            plan['filesToAdjust'].append(record[1])
+        elif record[0] == "adjustDirectory":
+            destTree['directories'][record[1]] = record[2]
+            plan['directoriesToAdjust'].append(record[1])
+    if ended:
+        logger.info("Journal '{0}': Run already completed".format(p.journal))
+    else:
+        logger.info("Journal '{0}': {1} of {2} operations already done. Resuming".format(p.journal, len(done), total))
+    journal = Journal(p.journal, validLength, backedUp) if not p.checkMode else None
+    return (journal, srcTree, destTree, target, plan)
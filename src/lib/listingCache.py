@@ -0,0 +1,119 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import marshal
+import hashlib
+import sqlite3
+import threading
+import misc
+
+"""
+A local cache of HDFS directories content, stored in a SQLite file per (endpoint, root path).
+
+Each directory is stored with its HDFS modification time (in ms). On next run, if this time is unchanged, 
+the directory content is served from the cache instead of being listed again.
+
+Note the modification time of a directory only change when an entry is added, removed or renamed in it. 
+Not on changes deeper in the tree, nor on attributes changes of its entries. So:
+- A directory served from the cache does not provide up to date modification times for its sub-directories. 
+  These must be checked by a GETFILESTATUS, which is much cheaper than listing them.
+- Owner/group/mode of entries may be stale. So, callers must invalidate directories in which they change attributes.
+"""
+
+class ListingCache:
+    
+    def __init__(self, cacheDir, endpoint, rroot):
+        misc.ensureFolder(cacheDir)
+        key = hashlib.sha1("{0}:{1}".format(endpoint, rroot)).hexdigest()
+        self.path = os.path.join(cacheDir, key + ".db")
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("CREATE TABLE IF NOT EXISTS listing (path TEXT PRIMARY KEY, mtime INTEGER, entries BLOB)")
+        self.visited = set()
+        self.retained = []
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, path, mtime):
+        """ Return the list of entries of this directory, or None if not in cache or modified since. """
+        with self.lock:
+            self.visited.add(path)
+            row = self.db.execute("SELECT mtime, entries FROM listing WHERE path = ?", (path,)).fetchone()
+            if row == None or row[0] != mtime:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return marshal.loads(str(row[1]))
+    
+    def put(self, path, mtime, entries):
+        data = buffer(marshal.dumps(entries))
+        with self.lock:
+            self.visited.add(path)
+            self.db.execute("INSERT OR REPLACE INTO listing (path, mtime, entries) VALUES (?, ?, ?)", (path, mtime, data))
+            
+    def retain(self, path):
+        """ Keep directories of this subtree, even if not visited """
+        with self.lock:
+            self.retained.append(os.path.join(path, ""))
+
+    def invalidate(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM listing WHERE path = ?", (path,))
+    
+    def commit(self):
+        """ Drop directories not seen during the walk (Removed, or no more accessible) and persist """
+        with self.lock:
+            retained = tuple(self.retained)
+            stale = [ row[0] for row in self.db.execute("SELECT path FROM listing") if row[0] not in self.visited and not (row[0] + "/").startswith(retained) ]
+            for path in stale:
+                self.db.execute("DELETE FROM listing WHERE path = ?", (path,))
+            self.db.commit()
+    
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def entryToTuple(entryType, entry):
+    if entryType == 'FILE':
+        return ('F', entry['name'], entry['size'], entry['modificationTime'], entry['mode'], entry['owner'], entry['group'])
+    else:
+        return ('D', entry['name'], entry['modificationTimeMs'], entry['mode'], entry['owner'], entry['group'])
+
+def tupleToEntry(t):
+    entry = {}
+    entry['name'] = t[1]
+    if t[0] == 'F':
+        entry['size'] = t[2]
+        entry['modificationTime'] = t[3]
+        entry['mode'] = t[4]
+        entry['owner'] = t[5]
+        entry['group'] = t[6]
+        return ('FILE', entry)
+    else:
+        entry['modificationTimeMs'] = t[2]
+        entry['mode'] = t[3]
+        entry['owner'] = t[4]
+        entry['group'] = t[5]
+        return ('DIRECTORY', entry)
+
+def lookup(p, webHdfs, rroot):
+    """ Return the listing cache for this HDFS tree, or None if not enabled """
+    if p.listingCache == None:
+        return None
+    return ListingCache(p.listingCache, webHdfs.endpoint, rroot)
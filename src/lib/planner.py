@@ -0,0 +1,162 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import marshal
+import tempfile
+import threading
+from pruner import filterPruned
+
+"""
+Compare source and target trees, to find out what must be done. Shared by hdfsput and hdfsget.
+
+Both trees are read as streams sorted the same way (by directory, then by name. See EntryMap.itersorted()) 
+and merge-joined. So, there is no lookup in the target tree, and no global sort of the entries.
+
+Resulting files lists are SpillList, spilled to temporary files when their size exceed p.planBudget entries.
+"""
+
+def newPlan(p):
+    plan = {}
+    plan['directoriesToCreate'] = []
+    plan['directoriesToAdjust'] = []
+    plan['filesToCreate'] = SpillList(p.planBudget)
+    plan['filesToReplace'] = SpillList(p.planBudget)
+    plan['filesToAdjust'] = SpillList(p.planBudget)
+    plan['filesToCompare'] = SpillList(p.planBudget)   # With --compare checksum. See checksum.py
+    return plan
+
+
+def buildPlan(plan, srcTree, destTree, p):
+    # Subtrees pruned from target tree are identical to the source ones (See pruner.py). Nothing to do there.
+    pruned = destTree.get('pruned', [])
+    # Lookup all folder to create or adjust on target
+    for ((prefix, name), srcStatus, destStatus) in mergeJoin(filterPruned(srcTree['directories'].itersorted(), pruned), destTree['directories'].itersorted()):
+        dirName = prefix + name
+        if destStatus != None:
+            if checkAttrOnExistingDir(destStatus, p):
+                plan['directoriesToAdjust'].append(dirName)
+        else:
+            plan['directoriesToCreate'].append(os.path.join(destTree['rroot'], dirName))
+    plan['directoriesToAdjust'].sort()
+    plan['directoriesToCreate'].sort()
+
+    for ((prefix, name), srcStatus, destStatus) in mergeJoin(filterPruned(srcTree['files'].itersorted(), pruned), destTree['files'].itersorted()):
+        fileName = prefix + name
+        if destStatus != None:
+            if srcStatus['size'] != destStatus['size']:
+                plan['filesToReplace'].append(fileName)
+            elif p.compare == "checksum" and srcStatus['size'] > 0:
+                plan['filesToCompare'].append(fileName)
+            elif srcStatus['modificationTime'] != destStatus['modificationTime']:
+                plan['filesToReplace'].append(fileName)
+            elif checkAttrOnExistingFile(destStatus, p):
+                plan['filesToAdjust'].append(fileName)
+        else:
+            plan['filesToCreate'].append(fileName)
+    return plan
+
+
+def planDirectoryCreation(directoriesToCreate):
+    """
+    Creating a directory also creates its missing parents (MKDIRS, os.makedirs()). So only leaf directories need to be created.
+    Return { <leaf directory>: [ <directories created with it> ] }. Each directory is assigned to a single leaf.
+    """
+    directories = set(directoriesToCreate)
+    parents = set(os.path.dirname(d) for d in directories)
+    createdBy = {}
+    assigned = set()
+    for leaf in sorted(d for d in directories if d not in parents):
+        createdBy[leaf] = []
+        d = leaf
+        while d in directories and d not in assigned:
+            createdBy[leaf].append(d)
+            assigned.add(d)
+            d = os.path.dirname(d)
+    return createdBy
+
+
+def mergeJoin(srcStream, destStream):
+    """ Yield (key, srcStatus, destStatus) for each key of srcStream. destStatus is None if key is not in destStream. """
+    dest = next(destStream, None)
+    for (key, srcStatus) in srcStream:
+        while dest != None and dest[0] < key:
+            dest = next(destStream, None)
+        if dest != None and dest[0] == key:
+            yield (key, srcStatus, dest[1])
+        else:
+            yield (key, srcStatus, None)
+
+
+def checkAttrOnExistingFile(fileStatus, p):
+    if p.owner != None and p.owner != fileStatus['owner']:
+        return True
+    if p.group != None and p.group != fileStatus['group']:
+        return True
+    if(p.mode != None and fileStatus['mode'] != p.mode):
+        return True
+    return False
+
+def checkAttrOnExistingDir(dirStatus, p):
+    if p.owner != None and p.owner != dirStatus['owner']:
+        return True
+    if p.group != None and p.group != dirStatus['group']:
+        return True
+    if(p.directoryMode != None and p.directoryMode != dirStatus['mode']):
+        return True
+    return False
+
+
+class SpillList:
+    """ 
+    An append-only list. Once more than 'budget' items are in memory, they are written to a temporary file, as a chunk.
+    Can be iterated several times, even concurrently. 
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.items = []
+        self.count = 0
+        self.spillFile = None
+        self.lock = threading.Lock()
+
+    def append(self, item):
+        self.items.append(item)
+        self.count += 1
+        if len(self.items) >= self.budget:
+            with self.lock:
+                if self.spillFile == None:
+                    self.spillFile = tempfile.TemporaryFile(prefix="hdfsmirror-")
+                self.spillFile.seek(0, os.SEEK_END)
+                marshal.dump(self.items, self.spillFile)
+            self.items = []
+
+    def __iter__(self):
+        if self.spillFile != None:
+            position = 0
+            while True:
+                with self.lock:
+                    self.spillFile.seek(position)
+                    try:
+                        chunk = marshal.load(self.spillFile)
+                    except EOFError:
+                        break
+                    position = self.spillFile.tell()
+                for item in chunk:
+                    yield item
+        for item in self.items:
+            yield item
+
+    def __len__(self):
+        return self.count
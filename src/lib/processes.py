@@ -0,0 +1,164 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import heapq
+import logging
+import multiprocessing
+import threading
+import time
+import Queue
+
+logger = logging.getLogger("hdfsmirror.processes")
+
+"""
+Multi-process copy (--nbrProcesses).
+
+With many threads, a single python process is bound by one core (HTTP framing, JSON parsing, logging...) long before
+the network is saturated. So files copy can be sharded on several processes, each with its own copy threads,
+scheduler and HTTP connections pool.
+
+Processes are forked once trees are built and the plan is done, so they inherit them. The main process still creates
+the directories. Then each file to copy is sent to the process with the less bytes assigned so far. Inside a process,
+files are served biggest first, as with a single process (See scheduler.py).
+
+Each process report its progress (files and bytes copied) every REPORT_PERIOD seconds, and its errors, copied files
+and checksum mismatches (--verify) at end. The main process see each process as a 'thread' with 'fileCount',
+'byteCount', 'lastFileTime', 'errorCount' and 'mismatched', so the usual progress (common.StatsThread) and reports
+are unchanged.
+"""
+
+REPORT_PERIOD = 1
+
+
+class Shard:
+    """ Main process side of a copy process """
+    def __init__(self, sid, inbox, process):
+        self.sid = sid
+        self.inbox = inbox
+        self.process = process
+        self.fileCount = 0
+        self.byteCount = 0
+        self.lastFileTime = None
+        self.errorCount = 0
+        self.copied = []
+        self.mismatched = []
+        self.ended = False
+
+
+class CopyProcesses:
+    """
+    Same put() interface as the scheduler, to queue files to copy. sizes is the 'files' map of the source tree.
+    start() is called in each process, and must return (queue, threads): A scheduler, and the started copy threads
+    getting files from it. Then finish() is called, once all copy threads are ended.
+    """
+    def __init__(self, nbrProcesses, sizes, start, finish):
+        self.sizes = sizes
+        self.outbox = multiprocessing.Queue()
+        self.shards = []
+        for sid in range(0, nbrProcesses):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(target=runShard, name="copy#{0}".format(sid), args=(sid, inbox, self.outbox, start, finish))
+            process.daemon = True
+            process.start()
+            self.shards.append(Shard(sid, inbox, process))
+        self.loads = [ (0, sid) for sid in range(0, nbrProcesses) ]
+        self.lock = threading.Lock()    # put() is called by several threads (directories creation)
+        self.collector = threading.Thread(target=self.collect, name="collector")
+        self.collector.daemon = True
+        self.collector.start()
+
+    def put(self, f):
+        with self.lock:
+            (load, sid) = self.loads[0]
+            heapq.heapreplace(self.loads, (load + self.sizes[f]['size'], sid))
+        self.shards[sid].inbox.put(f)
+
+    def collect(self):
+        """ Update shards from the messages of the processes, up to the end of all of them """
+        while not all(shard.ended for shard in self.shards):
+            try:
+                message = self.outbox.get(True, REPORT_PERIOD)
+            except Queue.Empty:
+                for shard in self.shards:
+                    if not shard.ended and not shard.process.is_alive():
+                        # Died without telling. Its last messages may be still in the pipe
+                        time.sleep(REPORT_PERIOD)
+                        if not shard.ended:
+                            logger.error("Copy process #{0} ended unexpectedly (exit code: {1})".format(shard.sid, shard.process.exitcode))
+                            shard.errorCount += 1
+                            shard.ended = True
+                continue
+            shard = self.shards[message[1]]
+            (shard.fileCount, shard.byteCount, shard.lastFileTime) = message[2:5]
+            if message[0] == "end":
+                (shard.errorCount, shard.copied, shard.mismatched) = message[5:8]
+                shard.ended = True
+
+    def join(self):
+        """ No more file to queue. Wait for all processes to end. Return the number of errors """
+        for shard in self.shards:
+            shard.inbox.put(None)
+        self.collector.join()
+        for shard in self.shards:
+            shard.process.join()
+        return sum(shard.errorCount for shard in self.shards)
+
+
+def runShard(sid, inbox, outbox, start, finish):
+    """ Body of a copy process """
+    (queue, threads) = start()
+    stopped = threading.Event()
+    def report():
+        while not stopped.wait(REPORT_PERIOD):
+            outbox.put(progressOf("progress", sid, threads))
+    reporter = threading.Thread(target=report, name="reporter")
+    reporter.daemon = True
+    reporter.start()
+    try:
+        while True:
+            f = inbox.get()
+            if f == None:
+                break
+            queue.put(f)
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+        stopped.set()
+        reporter.join()
+    # Copy errors. And a thread ended by an error left its None in the queue
+    errors = sum(t.errorCount for t in threads)
+    while not queue.empty():
+        if queue.get() == None:
+            errors += 1
+    try:
+        finish()
+    except (Exception, SystemExit) as e:
+        logger.error("Copy process #{0}: {1}".format(sid, e))
+        errors += 1
+    copied = []
+    mismatched = []
+    for t in threads:
+        copied.extend(getattr(t, "copied", []))
+        mismatched.extend(t.mismatched)
+    outbox.put(progressOf("end", sid, threads) + (errors, copied, mismatched))
+    outbox.close()
+    outbox.join_thread()
+
+
+def progressOf(kind, sid, threads):
+    lastFileTimes = [ t.lastFileTime for t in threads if t.lastFileTime != None ]
+    return (kind, sid, sum(t.fileCount for t in threads), sum(t.byteCount for t in threads), max(lastFileTimes) if len(lastFileTimes) > 0 else None)
@@ -0,0 +1,115 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import threading
+
+"""
+Subtree pruning, for the HDFS tree walk.
+
+Before listing an HDFS directory, its aggregates (Number of files, number of directories and total length, from
+GETCONTENTSUMMARY) are compared with the ones of the same directory in the other tree (already built). If they match,
+the subtree is assumed identical and is not listed. Its relative path is recorded in the tree 'pruned' list.
+
+This is a heuristic: In a pruned subtree, a file modified without size change, or a change of owner/group/mode, is missed.
+
+A GETCONTENTSUMMARY is issued only for directories having sub-directories on the other side. For a leaf directory,
+it would cost as much as the listing itself.
+"""
+
+class Pruner:
+
+    def __init__(self, webHdfs, aggregates):
+        self.webHdfs = webHdfs
+        self.aggregates = aggregates
+        self.lock = threading.Lock()
+        self.pruned = []
+        self.summaryCalls = 0
+        self.savedListings = 0
+
+    def prune(self, path, relPath):
+        """ Return True if the subtree must not be walked """
+        aggregate = self.aggregates.get(relPath)
+        if aggregate == None or aggregate[1] <= 1:
+            return False
+        summary = self.webHdfs.getContentSummary(path)
+        with self.lock:
+            self.summaryCalls += 1
+        if summary == None or [summary['fileCount'], summary['directoryCount'], summary['length']] != aggregate:
+            return False
+        with self.lock:
+            self.pruned.append(relPath)
+            self.savedListings += summary['directoryCount']
+        return True
+
+
+def lookup(p, webHdfs, otherTree):
+    """ Return a Pruner, or None if not enabled """
+    if not p.prune:
+        return None
+    return Pruner(webHdfs, computeAggregates(otherTree))
+
+
+def computeAggregates(tree):
+    """ Return { <relative directory path>: [ <fileCount>, <directoryCount>, <length> ] }. As HDFS, directoryCount include the directory itself """
+    aggregates = { "": [0, 1, 0] }
+    for ((prefix, name), _) in tree['directories'].itersorted():
+        if prefix.startswith("/"):
+            continue    # The target root may be stored with its absolute path
+        aggregates[prefix + name] = [0, 1, 0]
+        for d in ancestors(prefix):
+            aggregate = aggregates.get(d)
+            if aggregate != None:
+                aggregate[1] += 1
+    # Entries come grouped by directory. So, ancestors are updated once per directory
+    currentPrefix = None
+    for ((prefix, name), status) in tree['files'].itersorted():
+        if prefix != currentPrefix:
+            if currentPrefix != None:
+                addToAncestors(aggregates, currentPrefix, fileCount, length)
+            currentPrefix = prefix
+            fileCount = 0
+            length = 0
+        fileCount += 1
+        length += status['size']
+    if currentPrefix != None:
+        addToAncestors(aggregates, currentPrefix, fileCount, length)
+    return aggregates
+
+def addToAncestors(aggregates, prefix, fileCount, length):
+    for d in ancestors(prefix):
+        aggregate = aggregates.get(d)
+        if aggregate != None:
+            aggregate[0] += fileCount
+            aggregate[2] += length
+
+def ancestors(prefix):
+    """ 'a/b/' -> '', 'a', 'a/b' """
+    yield ""
+    i = prefix.find('/')
+    while i >= 0:
+        yield prefix[:i]
+        i = prefix.find('/', i + 1)
+
+
+def filterPruned(stream, pruned, inside=False):
+    """ Filter an EntryMap.itersorted() stream. Yield entries out of pruned subtrees (or inside them if 'inside' is True) """
+    pruned = set(pruned)
+    currentPrefix = None
+    for (key, status) in stream:
+        if key[0] != currentPrefix:
+            currentPrefix = key[0]
+            isInside = any(d in pruned for d in ancestors(currentPrefix))
+        if isInside == inside:
+            yield (key, status)
@@ -0,0 +1,270 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import Queue
+import heapq
+import itertools
+import threading
+import time
+import logging
+
+logger = logging.getLogger("hdfsmirror.scheduler")
+
+"""
+Size aware scheduling of the copy threads.
+
+Files are served biggest first (Longest Processing Time first): A thread takes the biggest waiting file each time it
+is free. So big files are started early, in parallel, and small ones fill the gaps in between and at the end. No thread
+is left alone with a big file once the others are done.
+
+Files are queued as soon as their directory exists. So a big file in a late created directory may still come late.
+
+DatanodeScheduler (hdfsget) also spread reads on datanodes: Block locations of each file are fetched first. Then a file
+(or a part of a file) is read from the replica holder with the less streams in progress, up to maxStreams per
+datanode. Among possible transfers, the ones on the less loaded datanodes come first, then the biggest.
+"""
+
+
+class Scheduler(Queue.PriorityQueue):
+    """
+    The queue of copy threads. sizes is the 'files' map of the source tree.
+    Parts of a file (putPart()) are served before any file, so a big file split in parts use all threads.
+    None, to end a thread, is served last.
+    """
+    def __init__(self, sizes):
+        Queue.PriorityQueue.__init__(self)
+        self.sizes = sizes
+        self.counter = itertools.count()
+
+    def put(self, f):
+        if f == None:
+            Queue.PriorityQueue.put(self, (2, 0, next(self.counter), None))
+        else:
+            Queue.PriorityQueue.put(self, (1, -self.sizes[f]['size'], next(self.counter), f))
+
+    def putPart(self, part, hosts=None):
+        """ part is (<partialFile>, <offset>, <length>). hosts, of its block, are not used here """
+        Queue.PriorityQueue.put(self, (0, 0, next(self.counter), part))
+
+    def get(self):
+        return Queue.PriorityQueue.get(self)[3]
+
+    def takeBlocks(self, f):
+        """ Block locations of f. Not known here """
+        return None
+
+    def datanode(self):
+        """ Datanode to read the last item got by the calling thread from. None: Let the namenode choose """
+        return None
+
+    def release(self, size):
+        """ The last item got by the calling thread is done """
+        pass
+
+
+class DatanodeScheduler:
+    """
+    Same interface as Scheduler. locate(f) return the block locations of f, as WebHDFS.getFileBlockLocations().
+    After get(), the calling thread must read from datanode(), then call release(). After getting a file, it must call
+    takeBlocks(f) to get its locations (Needed to queue its parts) and release memory.
+    """
+    def __init__(self, sizes, locate, maxStreams):
+        self.sizes = sizes
+        self.locate = locate
+        self.maxStreams = maxStreams
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.unresolved = []    # Heap of (-size, seq, f): Files without locations yet
+        self.free = []          # Heap of (class, -size, seq, item): Items without known locations
+        self.heaps = {}         # host -> Heap of (class, -size, seq, item), for items with a replica on this host
+        self.copies = {}        # seq -> Number of copies left in heaps, for items with several hosts
+        self.taken = set()      # seq of items taken, with copies left in other heaps
+        self.waiting = 0        # Number of items (None excluded) not taken yet
+        self.ends = 0           # Number of None
+        self.active = {}        # host -> Number of streams in progress
+        self.blocks = {}        # f -> Block locations, from resolution up to takeBlocks()
+        self.stats = {}         # host -> [ <transfers>, <bytes>, <seconds> ]
+        self.current = threading.local()
+
+    def put(self, f):
+        with self.condition:
+            if f == None:
+                self.ends += 1
+            else:
+                heapq.heappush(self.unresolved, (-self.sizes[f]['size'], next(self.counter), f))
+                self.waiting += 1
+            self.condition.notify()
+
+    def putPart(self, part, hosts=None):
+        with self.condition:
+            self.add(0, part[2], part, hosts)
+            self.condition.notify_all()
+
+    def add(self, cls, size, item, hosts):
+        entry = (cls, -size, next(self.counter), item)
+        self.waiting += 1
+        if not hosts:
+            heapq.heappush(self.free, entry)
+            return
+        for host in hosts:
+            heapq.heappush(self.heaps.setdefault(host, []), entry)
+        if len(hosts) > 1:
+            self.copies[entry[2]] = len(hosts)
+
+    def top(self, heap):
+        """ Return the first entry of the heap, after removing the copies of taken items """
+        while len(heap) > 0 and heap[0][2] in self.taken:
+            self.popCopy(heap)
+        return heap[0] if len(heap) > 0 else None
+
+    def popCopy(self, heap):
+        seq = heapq.heappop(heap)[2]
+        if seq in self.copies:
+            self.copies[seq] -= 1
+            if self.copies[seq] == 0:
+                del self.copies[seq]
+                self.taken.discard(seq)
+            else:
+                self.taken.add(seq)
+
+    def pick(self):
+        """ Return (key, entry, host) of the best item, or None if none can be started now """
+        best = None
+        entry = self.top(self.free)
+        if entry != None:
+            best = ((entry[0], 0) + entry[1:3], entry, None)
+        for (host, heap) in self.heaps.iteritems():
+            if self.active.get(host, 0) >= self.maxStreams:
+                continue
+            entry = self.top(heap)
+            if entry != None:
+                key = (entry[0], self.active.get(host, 0)) + entry[1:3]
+                if best == None or key < best[0]:
+                    best = (key, entry, host)
+        return best
+
+    def get(self):
+        while True:
+            with self.condition:
+                while True:
+                    if len(self.unresolved) > 0:
+                        (_, _, f) = heapq.heappop(self.unresolved)
+                        break
+                    best = self.pick()
+                    if best != None:
+                        (_, entry, host) = best
+                        self.waiting -= 1
+                        if host == None:
+                            heapq.heappop(self.free)
+                        else:
+                            self.popCopy(self.heaps[host])
+                            self.active[host] = self.active.get(host, 0) + 1
+                        self.current.host = host
+                        self.current.start = time.time()
+                        return entry[3]
+                    if self.waiting == 0 and self.ends > 0:
+                        self.ends -= 1
+                        self.current.host = None
+                        return None
+                    self.condition.wait()
+            # Locations are fetched out of the lock. On failure, let the namenode choose the datanode
+            try:
+                blocks = self.locate(f)
+            except (Exception, SystemExit) as e:
+                logger.warning("{0}: Unable to get block locations{1}. Reading from the datanode chosen by the namenode".format(f, "" if isinstance(e, SystemExit) else " ({0})".format(e)))
+                blocks = None
+            with self.condition:
+                self.waiting -= 1
+                if blocks:
+                    self.blocks[f] = blocks
+                    self.add(1, self.sizes[f]['size'], f, blocks[0][2])
+                else:
+                    self.add(1, self.sizes[f]['size'], f, None)
+                self.condition.notify_all()
+
+    def empty(self):
+        with self.condition:
+            return self.waiting == 0 and self.ends == 0
+
+    def takeBlocks(self, f):
+        with self.condition:
+            return self.blocks.pop(f, None)
+
+    def datanode(self):
+        return getattr(self.current, "host", None)
+
+    def release(self, size):
+        """ size: Bytes transferred. 0 if none (i.e. file split in parts, or error) """
+        host = self.datanode()
+        if host == None:
+            return
+        with self.condition:
+            self.active[host] -= 1
+            if size > 0:
+                stats = self.stats.setdefault(host, [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += size
+                stats[2] += time.time() - self.current.start
+            self.current.host = None
+            self.condition.notify_all()
+
+    def printReport(self):
+        if len(self.stats) == 0:
+            return
+        print("{0:30} {1:>10} {2:>14} {3:>10} {4:>12}".format("datanode", "transfers", "bytes", "MB/s", "latency (s)"))
+        for host in sorted(self.stats):
+            (transfers, size, seconds) = self.stats[host]
+            print("{0:30} {1:10} {2:14} {3:10.1f} {4:12.3f}".format(host, transfers, size, size / 1048576.0 / max(seconds, 1e-6), seconds / transfers))
+
+
+def hostsAt(blocks, offset):
+    """ Hosts of the block at offset """
+    for (blockOffset, length, hosts) in blocks:
+        if blockOffset <= offset < blockOffset + length:
+            return hosts
+    return None
+
+
+def transferSizes(size, partSize):
+    """ Sizes of the transfers of a file, split in parts of partSize bytes """
+    if size <= partSize:
+        return [size]
+    return [ min(partSize, size - offset) for offset in range(0, size, partSize) ]
+
+
+def estimateMakespan(sizes, nbrThreads):
+    """ Return the bytes copied by the most loaded thread, if files are handled biggest first by the first free thread """
+    loads = [0] * nbrThreads
+    for size in sorted(sizes, reverse=True):
+        heapq.heapreplace(loads, loads[0] + size)
+    return max(loads)
+
+
+def printReport(threads, sizes, unit="thread", units="threads"):
+    """
+    sizes of all transfers (files or parts). threads have 'byteCount' and 'lastFileTime' (Time of their last file completion, or None).
+    unit, units: "process", "processes" when threads are copy processes.
+    """
+    total = sum(sizes)
+    if total == 0 or len(threads) == 0:
+        return
+    makespan = estimateMakespan(sizes, len(threads))
+    perfect = float(total) / len(threads)
+    print("{0} bytes on {1} {2}. Expected makespan: {3} bytes per {4}, {5:.0f}% above perfect balance".format(total, len(threads), units, makespan, unit, 100 * (makespan / perfect - 1)))
+    byteCounts = [ t.byteCount for t in threads ]
+    print("Bytes per {0}: min {1}, max {2} ({3:.0f}% above perfect balance)".format(unit, min(byteCounts), max(byteCounts), 100 * (max(byteCounts) / perfect - 1)))
+    lastFileTimes = [ t.lastFileTime for t in threads if t.lastFileTime != None ]
+    if len(lastFileTimes) > 0:   # None if all copies failed
+        print("Last file completion spread between {0}: {1:.1f}s".format(units, max(lastFileTimes) - min(lastFileTimes)))
@@ -0,0 +1,124 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import threading
+from contextlib import contextmanager
+from urlparse import urlparse
+import requests
+import logging
+
+logger = logging.getLogger("hdfsmirror.WebHDFS")
+
+"""
+A pool of keep-alive HTTP sessions, one set per host (namenode or datanode).
+
+A session is borrowed by one thread at a time, so its underlying connection is never shared.
+On release, at most 'size' idle sessions are kept for each host. Extra ones are closed.
+
+Each session hold a single connection to a single host. So, the urllib3 counters of the session
+tell us how many connections were opened and how many requests were issued on them.
+
+If a monitor is set (See concurrency.py), responses and connection errors are reported to it.
+"""
+
+class SessionPool:
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.live = set()
+        self.closedConnections = 0
+        self.closedRequests = 0
+        self.monitor = None
+
+    def acquire(self, host):
+        with self.lock:
+            free = self.idle.get(host)
+            if free:
+                return free.pop()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks['response'].append(self.onResponse)
+        with self.lock:
+            self.live.add(session)
+        logger.debug("New HTTP session for {0}".format(host))
+        return session
+
+    def release(self, host, session):
+        with self.lock:
+            free = self.idle.setdefault(host, [])
+            if len(free) < self.size:
+                free.append(session)
+                return
+        self.discard(session)
+
+    def discard(self, session):
+        with self.lock:
+            (connections, nbrRequests) = countersOf(session)
+            self.closedConnections += connections
+            self.closedRequests += nbrRequests
+            self.live.discard(session)
+        session.close()
+
+    @contextmanager
+    def session(self, url):
+        host = urlparse(url).netloc
+        s = self.acquire(host)
+        try:
+            yield s
+        except requests.exceptions.RequestException:
+            if self.monitor != None:
+                self.monitor.onError()
+            raise
+        finally:
+            self.release(host, s)
+
+    def onResponse(self, resp, *args, **kwargs):
+        if self.monitor != None:
+            self.monitor.onResponse(resp)
+
+    def getStats(self):
+        """ Return (<Number of connections opened>, <Number of requests sent on an already opened connection>) """
+        with self.lock:
+            connections = self.closedConnections
+            nbrRequests = self.closedRequests
+            for session in self.live:
+                (c, r) = countersOf(session)
+                connections += c
+                nbrRequests += r
+        return (connections, nbrRequests - connections)
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.live)
+            self.idle = {}
+        for session in sessions:
+            self.discard(session)
+
+
+def countersOf(session):
+    connections = 0
+    nbrRequests = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool != None:
+                connections += pool.num_connections
+                nbrRequests += pool.num_requests
+    return (connections, nbrRequests)
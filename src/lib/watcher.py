@@ -0,0 +1,138 @@
+# Copyright (C) 2016 BROADSoftware
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+#limitations under the License.
+#
+
+import os
+import errno
+import time
+import logging
+from inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR
+
+logger = logging.getLogger("hdfsmirror.watcher")
+
+"""
+Watch a local tree with inotify, and report changes as batches of paths, relative to the root:
+
+{
+    'files': set([ 'a/f1.txt', ... ]),          # Written, moved in, or with changed attributes
+    'directories': set([ 'a/b', ... ]),         # Created or moved in
+    'overflow': False                           # True if some events were lost. A full rescan is then required
+}
+
+A new directory is watched as soon as it appears, then walked. So, files created in it before the watch was set
+are reported too. Deletions are not reported, as hdfsput never deletes anything on target.
+
+Raise OSError (ENOSPC) when the number of watches exceed fs.inotify.max_user_watches.
+"""
+
+MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_ATTRIB | IN_ONLYDIR
+
+
+def newBatch():
+    return { 'files': set(), 'directories': set(), 'overflow': False }
+
+
+class TreeWatcher:
+
+    def __init__(self, rroot):
+        self.rroot = rroot
+        self.inotify = Inotify()
+        self.paths = {}
+        self.batch = newBatch()
+        self.addTree("", False)
+
+    def addTree(self, top, report=True):
+        todo = [top]
+        while len(todo) > 0:
+            current = todo.pop()
+            path = os.path.join(self.rroot, current)
+            try:
+                wd = self.inotify.addWatch(path, MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                continue    # Removed meanwhile, or not a directory any more
+            self.paths[wd] = current
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            for name in names:
+                child = os.path.join(current, name)
+                childPath = os.path.join(self.rroot, child)
+                if os.path.isdir(childPath):
+                    if report:
+                        self.batch['directories'].add(child)
+                    if not os.path.islink(childPath):
+                        todo.append(child)
+                elif report:
+                    self.batch['files'].add(child)
+
+    def removeTree(self, top):
+        """ Stop watching a directory moved away. If moved inside the tree, it will be watched again under its new name """
+        prefix = os.path.join(top, "")
+        for (wd, current) in self.paths.items():
+            if current == top or current.startswith(prefix):
+                self.inotify.removeWatch(wd)
+                del self.paths[wd]
+
+    def next(self, debounce):
+        """
+        Wait for changes, and return them once no event was received for 'debounce' seconds.
+        On a tree continuously modified, return after 10 times this delay.
+        """
+        events = []
+        while len(events) == 0:
+            events = self.inotify.read()
+        deadline = time.time() + 10 * debounce
+        while len(events) > 0:
+            self.handle(events)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            events = self.inotify.read(min(debounce, remaining))
+        batch = self.batch
+        self.batch = newBatch()
+        if batch['overflow']:
+            # Directories created meanwhile may be unwatched
+            self.addTree("", False)
+        return batch
+
+    def handle(self, events):
+        for (wd, mask, _, name) in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("{0}: inotify event queue overflow".format(self.rroot))
+                self.batch['overflow'] = True
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            current = self.paths.get(wd)
+            if current == None or name == "":
+                continue
+            path = os.path.join(current, name)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.removeTree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.batch['directories'].add(path)
+                    self.addTree(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                self.batch['files'].add(path)
+            elif mask & IN_CREATE and os.path.islink(os.path.join(self.rroot, path)):
+                # No close for a symlink
+                self.batch['files'].add(path)
+
+    def close(self):
+        self.inotify.close()